@@ -1,17 +1,35 @@
 #! /usr/bin/env python3
 # author: TODO: Joel Sivanish
 
-from json import loads  # steps 3, 4
-from requests import get  # steps 3, 4
-from socket import gethostbyname  # step 1
-from subprocess import getstatusoutput  # step 2
-from sys import argv  # command line arguments
-import matplotlib.pyplot as plt #for temp plotting function
-import numpy as np #for temp plotting function
+from json import dump, load, loads  # steps 3, 4
+try:
+    from fcntl import LOCK_EX, flock    # serializes cache file merges between runs (not on Windows)
+except ImportError:
+    flock = None
+from requests import Session  # steps 3, 4
+from requests.adapters import HTTPAdapter  # connection pooling for steps 3, 4
+from atexit import register as atexit_register  # cache files are written once, at exit
+from concurrent.futures import ThreadPoolExecutor  # --batch pipeline stages
+from os import O_WRONLY, devnull, dup2, environ, getpid, makedirs, open as os_open, replace  # config overrides, geocode cache file
+from os.path import dirname, expanduser
+from re import compile as re_compile  # address normalization
+from socket import create_connection, gethostbyname  # steps 1, 2
+from sys import argv, exit, stdin, stdout  # command line arguments, --batch domain list
+from threading import Event, Lock, Semaphore  # --batch pipeline bookkeeping
+from time import time  # geocode cache expiry
 
 # Takes an array of temps
-# and plots them.
-def plot_temps(temps):
+# and plots them. With out set to a .png/.svg path the plot is written
+# there instead of opened in a window, so no display is needed.
+def plot_temps(temps, out=None):
+    # matplotlib is imported here rather than at the top: it costs a few
+    # hundred ms of startup, which runs that fail early or use --data/--batch
+    # never need.
+    import matplotlib
+    if out:
+        matplotlib.use("Agg")   # non-interactive backend, must come before pyplot
+    import matplotlib.pyplot as plt
+
     xs = [x for x in range(len(temps))]
     plt.plot(xs, temps, label="Hourly tempatures")
 
@@ -20,34 +38,112 @@ def plot_temps(temps):
     plt.ylabel("Temperature F.")
     #Make sure we show the legend.
     plt.legend()
-    #Show the plot
-    plt.show()
+    #Show the plot, or save it (format from the file extension)
+    if out:
+        plt.savefig(out)
+        plt.close()
+    else:
+        plt.show()
+
+# Upstream base URLs (override to point at local stand-ins, e.g. for benchmarks)
+CENSUS_GEOCODER_URL = environ.get("LAB2_CENSUS_URL", "https://geocoding.geo.census.gov/geocoder")
+WEATHER_API_URL = environ.get("LAB2_WEATHER_URL", "https://api.weather.gov")
+
+# Shared HTTP session for steps 3 and 4: connections to the Census and
+# weather.gov hosts are kept alive and reused instead of reconnecting per call.
+HTTP_CONNECT_TIMEOUT = 3.05     # seconds to establish a connection
+HTTP_READ_TIMEOUT = 10          # seconds to wait for the response
+HTTP_POOL_SIZE = 4              # max open connections per host
+
+def make_session() -> Session:
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+http = make_session()
+
+def http_get(url: str, **kwargs):           # GET through the pooled session with timeouts
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return http.get(url, **kwargs)
 
 # Step 1 helper: domain -> ip
 def resolve_ip(domain: str) -> str:         # Defines a function where the parameter is a string
     return gethostbyname(domain)            # Returns the DNS-A record lookup result
 
 # Step 2 helpers: whois + address extraction
-def whois_lookup(ip: str) -> str:           # Calls the system whois tool and returns its raw text output
-    status, output = getstatusoutput(f"whois {ip}")
-    if status != 0:         # Tests for non-zero exit
-        raise RuntimeError(f"whois failed for {ip}")        # Throws an exception, stopping execution
-    return output
+# whois is spoken directly over TCP port 43 (no whois binary needed).
+# Start at IANA (or LAB2_WHOIS_SERVER as "host[:port]") and follow referrals.
+WHOIS_SERVER = environ.get("LAB2_WHOIS_SERVER", "whois.iana.org")
+WHOIS_PORT = 43
+WHOIS_TIMEOUT = 10
+WHOIS_MAX_REFERRALS = 3
+
+def split_server(server: str):              # "host" or "host:port" -> (host, port)
+    host, _, port = server.partition(":")
+    return host, int(port) if port.isdigit() else WHOIS_PORT
+
+def whois_query_line(server: str, ip: str) -> str:
+    # ARIN only returns the full network record for "n + <ip>"
+    if split_server(server)[0] == "whois.arin.net":
+        return f"n + {ip}"
+    return ip
+
+def whois_referral(whois_text: str) -> str | None:     # Next server named in a response
+    for l in whois_text.splitlines():
+        if ":" not in l:
+            continue
+        k, v = l.split(":", 1)
+        key = k.strip().lower()
+        val = v.strip()
+        if key in ("refer", "whois") and val:   # IANA style
+            return val
+        if key == "referralserver" and val.startswith("whois://"):   # ARIN style
+            return val[len("whois://"):].rstrip("/")
+    return None
+
+def whois_query(server: str, query: str) -> str:    # One query, read until the server closes
+    with create_connection(split_server(server), timeout=WHOIS_TIMEOUT) as sock:
+        sock.sendall(query.encode() + b"\r\n")
+        chunks = []
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+    return b"".join(chunks).decode("utf-8", errors="replace")
+
+def whois_lookup(ip: str) -> str:           # Queries whois over TCP/43 and returns the most specific answer
+    server = WHOIS_SERVER
+    try:
+        text = whois_query(server, whois_query_line(server, ip))
+        for _ in range(WHOIS_MAX_REFERRALS):
+            ref = whois_referral(text)
+            if ref is None or split_server(ref) == split_server(server):
+                break
+            server = ref
+            text = whois_query(server, whois_query_line(server, ip))
+    except OSError as e:        # Connection refused, timeout, DNS failure for the server...
+        raise RuntimeError(f"whois failed for {ip}: {e}")        # Throws an exception, stopping execution
+    return text.rstrip("\n")
 
 def extract_address(whois_text: str) -> str | None:
     """
-    Heuristic parser for common whois fields.
+    Heuristic parser for common whois fields, in a single pass.
     Tries Address/City/State/PostalCode/Country (Org* variants too),
     then falls back to the first 'Address:' line.
     """
-    lines = [l.strip() for l in whois_text.splitlines()]    # Splits text into lines while creating a list
     addr = city = state = zipc = country = None     # Initialize these variables to None
-    for l in lines:
+    fallback = None     # first line containing 'address:', remembered during the same pass
+    for l in whois_text.splitlines():
         if ":" not in l:        # skips lines without (key: value) format
             continue
         k, v = l.split(":", 1)      # splits into 2 parts only
         key = k.strip().lower()     # Checks if key matches any of the allowed field names
         val = v.strip()
+        if fallback is None and "address:" in l.lower():
+            fallback = val
         # Builds multi-line street addresses
         if key in ("address", "street", "street address", "orgaddress"):
             addr = f"{addr} {val}".strip() if addr else val
@@ -63,21 +159,110 @@ def extract_address(whois_text: str) -> str | None:
     if parts:
         return ", ".join(parts)
 
-    for l in lines:
-        low = l.lower()
-        if "address:" in low:
-            return l.split(":", 1)[1].strip()
-        return None
+    return fallback     # None if no line mentioned an address at all
 
 # ---- Step 3 helper: Census Geocoding API ----
-def geocode_address_one_line(address: str):
-    url = "https://geocoding.geo.census.gov/geocoder/locations/onelineaddress"
+# Results are kept in a small JSON file keyed by a normalized address, so the
+# same registrant address (from any domain, with any spacing/case/punctuation)
+# is only geocoded once. "No match" answers are kept too, for less time.
+# Set LAB2_GEOCODE_CACHE="" to turn the file off.
+GEOCODE_CACHE_PATH = environ.get("LAB2_GEOCODE_CACHE", expanduser("~/.cache/cscd330/geocode.json"))
+GEOCODE_TTL = 7 * 24 * 60 * 60      # seconds a match is trusted
+GEOCODE_MISS_TTL = 6 * 60 * 60      # seconds a "no match" is trusted
+
+ZIP_RE = re_compile(r"\b(\d{5})(?:-\d{4})?\b")
+WORD_RE = re_compile(r"[a-z0-9]+")
+
+def normalize_address(address: str) -> str:      # Same folding as lab3, flattened to one string key
+    text = address.lower()
+    zips = list(ZIP_RE.finditer(text))
+    zipc = ""
+    if zips:                            # the last ZIP-looking number is the ZIP
+        m = zips[-1]
+        zipc = m.group(1)
+        text = text[:m.start()] + " " + text[m.end():]
+    words = WORD_RE.findall(text)       # drops punctuation and extra whitespace
+    while words and words[-1] in ("us", "usa"):
+        words.pop()
+    if zipc and words and len(words[-1]) == 2 and words[-1].isalpha():     # ZIP already pins the state
+        words.pop()
+    return " ".join(words) + "|" + zipc
+
+def read_json_cache(path: str) -> dict:      # {key: [value, expires_at]}, empty if off/missing/corrupt
+    if not path:
+        return {}
+    try:
+        with open(path) as fh:
+            return load(fh)
+    except (OSError, ValueError):
+        return {}
+
+# Each cache file is read once per process and kept in memory. New entries
+# are collected and merged into the file once, when the run ends, instead of
+# rewriting the whole file for every lookup.
+loaded_caches = {}      # path -> {key: [value, expires_at]}
+new_entries = {}        # path -> entries this process added, not yet written
+cache_lock = Lock()     # --batch threads share the caches
+
+def cached_value(path: str, key: str):       # Live value for key, or None
+    if not path:
+        return None
+    with cache_lock:
+        if path not in loaded_caches:
+            loaded_caches[path] = read_json_cache(path)
+        entry = loaded_caches[path].get(key)
+    if entry is not None and entry[1] > time():
+        return entry[0]
+    return None
+
+def cache_value(path: str, key: str, value, ttl: float):     # Remember an entry; written by flush_json_caches()
+    if not path:
+        return
+    entry = [value, time() + ttl]
+    with cache_lock:
+        loaded_caches.setdefault(path, {})[key] = entry
+        new_entries.setdefault(path, {})[key] = entry
+
+def flush_json_caches():                    # Merge new entries into their files atomically
+    with cache_lock:
+        for path, entries in new_entries.items():
+            try:
+                makedirs(dirname(path) or ".", exist_ok=True)
+                with open(f"{path}.lock", "a") as lock_fh:
+                    if flock is not None:       # other lab2 runs merge one at a time
+                        flock(lock_fh, LOCK_EX)
+                    merged = read_json_cache(path)      # re-read so concurrent runs don't drop each other's entries
+                    merged.update(entries)
+                    now = time()
+                    merged = {k: v for k, v in merged.items() if v[1] > now}
+                    tmp = f"{path}.{getpid()}.tmp"      # per process, so parallel runs don't share a temp file
+                    with open(tmp, "w") as fh:
+                        dump(merged, fh)
+                    replace(tmp, path)
+            except OSError:
+                pass                            # caching is best-effort
+        new_entries.clear()
+
+atexit_register(flush_json_caches)
+
+def geocode_address_one_line(address: str):     # Cached front end for geocode_census
+    key = normalize_address(address)
+    hit = cached_value(GEOCODE_CACHE_PATH, key)
+    if hit is not None:
+        return hit[0], hit[1]
+    lat, lon = geocode_census(address)
+    ttl = GEOCODE_MISS_TTL if lat is None else GEOCODE_TTL
+    cache_value(GEOCODE_CACHE_PATH, key, [lat, lon], ttl)
+    return lat, lon
+
+def geocode_census(address: str):
+    url = f"{CENSUS_GEOCODER_URL}/locations/onelineaddress"
     params = {
         "address": address,
         "benchmark": "Public_AR_Current",  # also ok: "2020"
         "format": "json"
     }
-    resp = get(url, params=params)  # <-- equals sign, not hyphen
+    resp = http_get(url, params=params)  # <-- equals sign, not hyphen
     js = loads(resp.text)
 
     # Optional sanity check:
@@ -92,18 +277,43 @@ def geocode_address_one_line(address: str):
     return coords["y"], coords["x"]
 
 # Step 4 helper: NOAA weather.gov hourly (all available hours)
-def get_hourly_temperatures(lat: float, lon: float) -> list[int]:
-    # weather.gov prefers a User-Agent with contact info
-    headers = {"User-Agent": "CSCD330-Lab2 (student@example.edu)"}
+# Forecasts are per 2.5 km NWS grid cell. The /points lookup (coordinate ->
+# cell) is cached for a month under the coordinate rounded to 0.01 degrees
+# (~1 km), and hourly temperatures are cached per cell for 30 minutes, so
+# nearby addresses and repeat runs skip both calls.
+POINTS_CACHE_PATH = environ.get("LAB2_POINTS_CACHE", expanduser("~/.cache/cscd330/points.json"))
+HOURLY_CACHE_PATH = environ.get("LAB2_HOURLY_CACHE", expanduser("~/.cache/cscd330/hourly.json"))
+POINTS_TTL = 30 * 24 * 60 * 60
+HOURLY_TTL = 30 * 60
+POINTS_PRECISION = 2        # decimal places kept from lat/lon
+
+# weather.gov prefers a User-Agent with contact info
+WEATHER_HEADERS = {"User-Agent": "CSCD330-Lab2 (student@example.edu)"}
+
+def lookup_grid(lat: float, lon: float) -> list:    # -> [office, gridX, gridY, hourly_url]
+    lat, lon = round(float(lat), POINTS_PRECISION), round(float(lon), POINTS_PRECISION)
+    key = f"{lat},{lon}"
+    cell = cached_value(POINTS_CACHE_PATH, key)
+    if cell is not None:
+        return cell
 
     # Discover the forecast endpoints for this point
-    points_url = f"https://api.weather.gov/points/{lat},{lon}"
-    p = get(points_url, headers=headers)
-    p_js = loads(p.text)
-    hourly_url = p_js["properties"]["forecastHourly"]
+    points_url = f"{WEATHER_API_URL}/points/{lat},{lon}"
+    p = http_get(points_url, headers=WEATHER_HEADERS)
+    props = loads(p.text)["properties"]
+    cell = [props["gridId"], props["gridX"], props["gridY"], props["forecastHourly"]]
+    cache_value(POINTS_CACHE_PATH, key, cell, POINTS_TTL)
+    return cell
+
+def get_hourly_temperatures(lat: float, lon: float) -> list[int]:
+    cell = lookup_grid(lat, lon)
+    key = f"{cell[0]}/{cell[1]},{cell[2]}"      # one forecast per grid cell
+    temps = cached_value(HOURLY_CACHE_PATH, key)
+    if temps is not None:
+        return temps
 
     # Fetch the hourly forecast
-    f = get(hourly_url, headers=headers)
+    f = http_get(cell[3], headers=WEATHER_HEADERS)
     f_js = loads(f.text)
     periods = f_js["properties"]["periods"]
 
@@ -118,9 +328,112 @@ def get_hourly_temperatures(lat: float, lon: float) -> list[int]:
     if unit == "C":
         temps = [round(t * 9/5 + 32) for t in temps]
 
+    cache_value(HOURLY_CACHE_PATH, key, temps, HOURLY_TTL)
     return temps
 
 
+# --batch: many domains through one process as a pipeline.
+# Each stage has its own thread pool, so at most this many lookups of each
+# kind run at once (whois servers and the APIs don't like floods), while
+# different domains move through different stages at the same time.
+PIPELINE_WORKERS = {"resolve": 8, "whois": 4, "geocode": 4, "forecast": 4}
+MAX_IN_FLIGHT = 64      # domains read ahead of the slowest stage
+
+def step_resolve(r: dict):
+    r["ip"] = resolve_ip(r["domain"])
+
+def step_whois(r: dict):
+    r["address"] = extract_address(whois_lookup(r["ip"]))
+    if not r["address"]:
+        raise LookupError("no mailing address in whois output")
+
+def step_geocode(r: dict):
+    r["lat"], r["lon"] = geocode_address_one_line(r["address"])
+    if r["lat"] is None:
+        raise LookupError("no geocoding match")
+
+def step_forecast(r: dict):
+    r["temps"] = get_hourly_temperatures(r["lat"], r["lon"])
+    if not r["temps"]:
+        raise LookupError("no hourly temperatures returned")
+
+PIPELINE = [("resolve", step_resolve), ("whois", step_whois), ("geocode", step_geocode), ("forecast", step_forecast)]
+
+def result_line(r: dict, error: str | None) -> str:     # One tab-separated line per domain
+    if error:
+        return f"{r['domain']}\tERROR\t{error}"
+    temps = r["temps"]
+    return (f"{r['domain']}\t{r['ip']}\t{r['lat']},{r['lon']}\t{len(temps)} hours\t"
+            f"{min(temps)}-{max(temps)}F\t{r['address']}")
+
+def run_pipeline(domains, emit=print):      # Streams result_line()s as each domain finishes
+    pools = {stage: ThreadPoolExecutor(max_workers=n) for stage, n in PIPELINE_WORKERS.items()}
+    in_flight = Semaphore(MAX_IN_FLIGHT)
+    emit_lock = Lock()
+    stopped = Event()                       # set once emit() fails; the rest is skipped
+    emit_errors = []
+
+    def finish(r: dict, error: str | None):
+        try:
+            with emit_lock:
+                if not stopped.is_set():
+                    emit(result_line(r, error))
+        except Exception as e:              # e.g. BrokenPipeError from `| head -1`
+            emit_errors.append(e)
+            stopped.set()
+        finally:
+            in_flight.release()             # always, or the wait below never ends
+
+    def advance(r: dict, i: int):           # Queue domain r for stage i
+        if i == len(PIPELINE) or stopped.is_set():
+            return finish(r, None)
+        stage, step = PIPELINE[i]
+
+        def run():
+            if stopped.is_set():            # queued before the stop: don't bother
+                return finish(r, None)
+            try:
+                step(r)
+            except Exception as e:          # one bad domain doesn't stop the rest
+                return finish(r, f"{stage}: {e}")
+            advance(r, i + 1)
+        pools[stage].submit(run)
+
+    for domain in domains:
+        in_flight.acquire()                 # blocks reading more input while the pipeline is full
+        if stopped.is_set():
+            in_flight.release()
+            break
+        advance({"domain": domain}, 0)
+    for _ in range(MAX_IN_FLIGHT):          # wait for the stragglers
+        in_flight.acquire()
+    for pool in pools.values():
+        pool.shutdown()
+    flush_json_caches()                     # one write per cache file for the whole batch
+    if emit_errors:
+        raise emit_errors[0]                # re-raised here, not lost in a pool thread
+
+def read_domains(args: list):               # Domains from the command line, else one per stdin line
+    if args and args != ["-"]:
+        yield from args
+        return
+    for line in stdin:
+        domain = line.split("#", 1)[0].strip()
+        if domain:
+            yield domain
+
+def batch_main(args: list):
+    def emit(line: str):
+        print(line, flush=True)             # flush so a reader sees each line immediately
+    try:
+        run_pipeline(read_domains(args), emit)
+    except BrokenPipeError:
+        # the reader quit early; point stdout at /dev/null so the flush at
+        # exit doesn't raise again, and stop quietly
+        dup2(os_open(devnull, O_WRONLY), stdout.fileno())
+        exit(1)
+
+
 def main():
     # TODO: Look at the code below for an example of how to do
     # API calls. I would recommend first uncommenting and
@@ -159,9 +472,25 @@ def main():
     """
  # Step 1: Domain -> IP
     if len(argv) < 2:
-        print(f"Usage: {argv[0]} <domain>")
+        print(f"Usage: {argv[0]} <domain> [--plot out.png|out.svg | --data]")
+        print(f"       {argv[0]} --batch [domain ...]   (no domains: read them from stdin)")
+        return
+    if argv[1] == "--batch":
+        batch_main(argv[2:])
         return
     domain = argv[1]
+    plot_out = None     # --plot FILE: render headless to FILE
+    data_only = False   # --data: print the temperatures, don't plot
+    args = argv[2:]
+    while args:
+        opt = args.pop(0)
+        if opt == "--plot" and args:
+            plot_out = args.pop(0)
+        elif opt == "--data":
+            data_only = True
+        else:
+            print(f"Unknown option: {opt}")
+            return
     print(f"[1] Resolving domain → IP for {domain} ...")
     ip = resolve_ip(domain)
     print(f"    IP: {ip}")
@@ -194,7 +523,14 @@ def main():
 
 
     # Step 5: Plotting
+    if data_only:
+        print("[5] Hourly temperatures (hour, F):")
+        for hour, temp in enumerate(temps):
+            print(f"{hour}\t{temp}")
+        return
     print(f"[5] Plotting temperatures...")
-    plot_temps(temps)
+    plot_temps(temps, plot_out)
+    if plot_out:
+        print(f"    Saved plot to {plot_out}")
 if __name__ == "__main__":
     main()
@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+# author: Joel Sivanish
+#
+# Load test for lab3.py (and lab2.py) against local stand-ins for every
+# upstream, so runs are fast, repeatable and never hit the real services:
+#   - a UDP DNS server answering siteN.bench with one A record (TTL 300)
+#   - a TCP whois server returning ARIN-style records (one network per /16)
+#   - a fake Census geocoder (onelineaddress JSON and addressbatch CSV)
+#   - a fake weather.gov (/points, forecast and hourly forecast)
+# Each fake can add latency and fail a fraction of requests.
+#
+# lab3 is started as a child process (so the load generator doesn't share its
+# GIL) with LAB3_* variables pointing at the fakes, then driven at a fixed
+# request rate. Latency is measured from when each request was *scheduled*,
+# so a server that falls behind is charged for the queueing too.
+#
+# Usage:
+#   python3 bench_load.py --rate 100 --duration 30
+#   python3 bench_load.py --lab3 ../../old/Labs/Lab3/lab3.py --label old --json runs.jsonl
+#   python3 bench_load.py --asgi --fault whois:200:0.05
+#   python3 bench_load.py --target lab2 --runs 20
+
+from argparse import ArgumentParser
+from collections import Counter
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from os import chmod, environ, pathsep
+from os.path import abspath, dirname, join
+from queue import Queue
+from random import Random
+from socketserver import BaseRequestHandler, ThreadingTCPServer, ThreadingUDPServer
+from struct import pack, unpack_from
+from subprocess import DEVNULL, PIPE, Popen
+from sys import executable
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from time import monotonic, perf_counter, sleep
+from urllib.parse import parse_qs, unquote, urlsplit
+from zlib import crc32
+
+HERE = dirname(abspath(__file__))
+ROUTES = ("address", "weather", "range")
+STAGES = ("resolve", "whois", "geocode", "points", "forecast")
+FAKE_UPSTREAM_CONCURRENCY = 64  # lab3 slots per fake upstream, unpaced
+
+
+##################################
+# Fault injection                #
+##################################
+
+class Fault:
+    """Latency (ms, +/- jitter) and error rate applied to one fake upstream."""
+
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, jitter: float = 0.25):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self._rng = Random()
+        self._lock = Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def apply(self) -> bool:
+        """Sleep for this request's latency; True if the request should fail."""
+        with self._lock:
+            self.requests += 1
+            delay = self.latency * (1 + self.jitter * (2 * self._rng.random() - 1))
+            fail = self._rng.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if delay > 0:
+            sleep(delay)
+        return fail
+
+
+##################################
+# Fake upstreams                 #
+##################################
+
+def domain_ip(i: int) -> str:
+    # 32 /16 networks, so whois, geocode and weather answers are shared by many domains
+    return f"100.{64 + i % 32}.{(i // 32) % 256}.{1 + i % 200}"
+
+def network_address(ip: str) -> tuple:
+    """(street, city, state, zip) registered for the /16 holding ip."""
+    n = int(ip.split(".")[1])
+    return f"{100 + n} Main St", f"Benchville {n}", "WA", f"{99000 + n}"
+
+def coordinates(address: str):
+    """A stable contiguous-US lat/lon for an address string."""
+    h = crc32(address.lower().encode())
+    return 30 + (h % 1800) / 100, -120 + (h // 1800 % 4500) / 100
+
+
+class DnsHandler(BaseRequestHandler):
+    fault = Fault()
+
+    def handle(self):
+        data, sock = self.request
+        if self.fault.apply():
+            return  # dropped; lab3 times out and falls back to getaddrinfo
+        qid, = unpack_from("!H", data)
+        off, labels = 12, []
+        while data[off]:
+            labels.append(data[off + 1:off + 1 + data[off]].decode())
+            off += 1 + data[off]
+        qtype, = unpack_from("!H", data, off + 1)
+        question = data[12:off + 5]
+
+        name = ".".join(labels).lower()
+        index = name[4:-6] if name.startswith("site") and name.endswith(".bench") else ""
+        if not index.isdigit():
+            sock.sendto(pack("!HHHHHH", qid, 0x8183, 1, 0, 0, 0) + question, self.client_address)
+            return
+        answers = b""
+        if qtype == 1:  # A only; AAAA gets an empty NOERROR answer
+            rdata = bytes(int(p) for p in domain_ip(int(index)).split("."))
+            answers = pack("!HHHIH", 0xC00C, 1, 1, 300, 4) + rdata
+        header = pack("!HHHHHH", qid, 0x8180, 1, 1 if answers else 0, 0, 0)
+        sock.sendto(header + question + answers, self.client_address)
+
+
+class WhoisHandler(BaseRequestHandler):
+    fault = Fault()
+
+    def handle(self):
+        query = self.request.recv(1024).decode().strip()
+        if self.fault.apply():
+            return  # close without an answer
+        ip = query.split()[-1]
+        if ip.count(".") != 3:
+            self.request.sendall(b"% No match\r\n")
+            return
+        street, city, state, postal = network_address(ip)
+        second = ip.split(".")[1]
+        self.request.sendall((
+            f"NetRange:       100.{second}.0.0 - 100.{second}.255.255\r\n"
+            f"CIDR:           100.{second}.0.0/16\r\n"
+            f"NetName:        BENCH-NET-{second}\r\n"
+            f"OriginAS:       AS{64500 + int(second)}\r\n"
+            f"OrgName:        Bench Org {second}\r\n"
+            f"Address:        {street}\r\n"
+            f"City:           {city}\r\n"
+            f"StateProv:      {state}\r\n"
+            f"PostalCode:     {postal}\r\n"
+            f"Country:        US\r\n"
+        ).encode())
+
+
+class FakeHTTPHandler(BaseHTTPRequestHandler):
+    """Shared plumbing for the fake Census and weather.gov servers."""
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+    fault = Fault()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: str, content_type: str = "application/json"):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.fault.apply():
+            return self.reply(503, '{"status": 503, "detail": "injected failure"}')
+        self.get(urlsplit(self.path))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.fault.apply():
+            return self.reply(503, "injected failure", "text/plain")
+        self.post(urlsplit(self.path), body)
+
+    def get(self, url):
+        self.reply(404, "{}")
+
+    def post(self, url, body: bytes):
+        self.reply(404, "")
+
+
+class CensusHandler(FakeHTTPHandler):
+    fault = Fault()
+
+    def get(self, url):
+        if not url.path.endswith("/locations/onelineaddress"):
+            return self.reply(404, "{}")
+        address = parse_qs(url.query).get("address", [""])[0]
+        matches = []
+        if "main st" in address.lower():
+            lat, lon = coordinates(address)
+            matches = [{"matchedAddress": address.upper(), "coordinates": {"x": lon, "y": lat}}]
+        self.reply(200, dumps({"result": {"addressMatches": matches}}))
+
+    def post(self, url, body: bytes):
+        # addressbatch: the CSV sits in the multipart body. Rows the one-line
+        # fake would match come back as a Match, the rest as No_Match.
+        if not url.path.endswith("/locations/addressbatch"):
+            return self.reply(404, "{}")
+        rows = []
+        for line in body.decode(errors="replace").splitlines():
+            parts = line.split(",")
+            if len(parts) >= 5 and parts[0].isdigit():
+                address = line.partition(",")[2]
+                if "main st" in address.lower():
+                    lat, lon = coordinates(address)
+                    rows.append(f'"{parts[0]}","{address}","Match","Exact","{address.upper()}",'
+                                f'"{lon},{lat}","0","L"')
+                else:
+                    rows.append(f'"{parts[0]}","{address}","No_Match"')
+        self.reply(200, "\n".join(rows) + "\n", "text/csv")
+
+
+class WeatherHandler(FakeHTTPHandler):
+    fault = Fault()
+
+    def get(self, url):
+        parts = unquote(url.path).strip("/").split("/")
+        base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        if parts[0] == "points" and len(parts) == 2:
+            lat, lon = (float(v) for v in parts[1].split(","))
+            office, x, y = "BEN", int((lat - 30) * 20), int((lon + 120) * 20)
+            grid = f"{base}/gridpoints/{office}/{x},{y}"
+            return self.reply(200, dumps({"properties": {
+                "gridId": office, "gridX": x, "gridY": y,
+                "forecast": f"{grid}/forecast", "forecastHourly": f"{grid}/forecast/hourly",
+            }}))
+        if parts[0] == "gridpoints" and parts[-1] in ("forecast", "hourly"):
+            periods = [{"temperature": 50 + h % 20, "temperatureUnit": "F",
+                        "detailedForecast": f"Sunny, with a high near {60 + h % 20}."}
+                       for h in range(156 if parts[-1] == "hourly" else 14)]
+            return self.reply(200, dumps({"properties": {"periods": periods}}))
+        self.reply(404, "{}")
+
+
+class Upstreams:
+    """Every fake server on an ephemeral localhost port, each on its own thread."""
+
+    def __init__(self, faults: dict):
+        ThreadingUDPServer.daemon_threads = ThreadingTCPServer.daemon_threads = True
+        ThreadingTCPServer.allow_reuse_address = True
+        self.servers = {}
+        for name, server_cls, handler in (
+            ("dns", ThreadingUDPServer, DnsHandler),
+            ("whois", ThreadingTCPServer, WhoisHandler),
+            ("census", ThreadingHTTPServer, CensusHandler),
+            ("weather", ThreadingHTTPServer, WeatherHandler),
+        ):
+            handler.fault = faults[name]
+            server = server_cls(("127.0.0.1", 0), handler)
+            Thread(target=server.serve_forever, daemon=True).start()
+            self.servers[name] = server
+        self.faults = faults
+
+    def address(self, name: str) -> str:
+        return "127.0.0.1:%d" % self.servers[name].server_address[1]
+
+    def lab3_env(self) -> dict:
+        return {
+            "LAB3_DNS_SERVER": self.address("dns"),
+            "LAB3_WHOIS_SERVER": self.address("whois"),
+            "LAB3_CENSUS_URL": f"http://{self.address('census')}",
+            "LAB3_WEATHER_URL": f"http://{self.address('weather')}",
+            "LAB3_DB": "",
+            # the fakes stand in for several real hosts each; don't let the
+            # per-host pacing meant for those be what the benchmark measures
+            # (a LAB3_UPSTREAM_LIMITS from the environment goes last, so its
+            # entries still win)
+            "LAB3_UPSTREAM_LIMITS": ",".join(
+                [f"{self.address(name)}={FAKE_UPSTREAM_CONCURRENCY}/0" for name in ("whois", "census", "weather")]
+                + [environ.get("LAB3_UPSTREAM_LIMITS", "")]),
+        }
+
+    def lab2_env(self) -> dict:
+        return {
+            "LAB2_WHOIS_SERVER": self.address("whois"),
+            "LAB2_CENSUS_URL": f"http://{self.address('census')}",
+            "LAB2_WEATHER_URL": f"http://{self.address('weather')}",
+            "MPLBACKEND": "Agg",  # plt.show() returns at once
+        }
+
+    def counts(self) -> dict:
+        return {name: {"requests": f.requests, "errors": f.errors} for name, f in self.faults.items()}
+
+    def close(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+
+##################################
+# Load generation                #
+##################################
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+def summarize(latencies: list) -> dict:
+    values = sorted(latencies)
+    return {f"p{p}": round(percentile(values, p) * 1000, 2) for p in (50, 90, 99)} | {
+        "max": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+def parse_mix(spec: str) -> dict:
+    """'address=4,weather=3,range=3' -> {route: weight}."""
+    mix = {}
+    for part in spec.split(","):
+        route, _, weight = part.partition("=")
+        if route not in ROUTES:
+            raise ValueError(f"unknown route {route!r}")
+        mix[route] = float(weight or 1)
+    return mix
+
+def zipf_weights(n: int, s: float) -> list:
+    # a few popular domains and a long tail, like real lookup traffic
+    return [1 / (i + 1) ** s for i in range(n)]
+
+def schedule(rate: float, duration: float, mix: dict, domains: int, zipf: float, seed: int):
+    """Yield (offset_seconds, route, domain) for an open-loop run."""
+    rng = Random(seed)
+    routes, route_weights = list(mix), list(mix.values())
+    names = [f"site{i}.bench" for i in range(domains)]
+    domain_weights = zipf_weights(domains, zipf)
+    for n in range(int(rate * duration)):
+        yield n / rate, rng.choices(routes, route_weights)[0], rng.choices(names, domain_weights)[0]
+
+def fetch(port: int, path: str, timeout: float = 60):
+    conn = HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        return resp.status, resp.read().decode(errors="replace")
+    finally:
+        conn.close()
+
+def cache_counters(port: int) -> dict:
+    """/cache/stats as {name: number}."""
+    _, body = fetch(port, "/cache/stats")
+    counters = {}
+    for line in body.splitlines():
+        name, _, value = line.partition(":")
+        try:
+            counters[name.strip()] = float(value)
+        except ValueError:
+            continue
+    return counters
+
+def hit_rates(before: dict, after: dict) -> dict:
+    """Hit ratio over the run for the route cache and every stage cache."""
+    rates = {}
+    for name, prefix in [("route", "")] + [(s, f"{s}_") for s in STAGES]:
+        hits = after.get(f"{prefix}hits", 0) - before.get(f"{prefix}hits", 0)
+        misses = after.get(f"{prefix}misses", 0) - before.get(f"{prefix}misses", 0)
+        if hits + misses:
+            rates[name] = round(hits / (hits + misses), 4)
+    return rates
+
+def drive(port: int, requests, concurrency: int) -> dict:
+    """Send every scheduled request on time from a pool of worker threads."""
+    queue = Queue(maxsize=concurrency * 4)
+    latencies = {route: [] for route in ROUTES}
+    statuses = Counter()
+    lock = Lock()
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            due, route, domain = item
+            try:
+                status, _ = fetch(port, f"/{route}/{domain}")
+            except OSError:
+                status = "conn_error"
+            elapsed = perf_counter() - due
+            with lock:
+                latencies[route].append(elapsed)
+                statuses[status] += 1
+
+    workers = [Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for w in workers:
+        w.start()
+    start = perf_counter()
+    for offset, route, domain in requests:
+        delay = start + offset - perf_counter()
+        if delay > 0:
+            sleep(delay)
+        queue.put((start + offset, route, domain))
+    for _ in workers:
+        queue.put(None)
+    for w in workers:
+        w.join()
+    elapsed = perf_counter() - start
+
+    total = sum(statuses.values())
+    everything = [t for ts in latencies.values() for t in ts]
+    return {
+        "requests": total,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+        "errors": total - statuses.get(200, 0),
+        "status": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        "latency_ms": summarize(everything),
+        "route_latency_ms": {route: summarize(ts) for route, ts in latencies.items() if ts},
+    }
+
+def wait_until_up(port: int, proc: Popen, timeout: float = 30):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"lab3 exited with status {proc.returncode}")
+        try:
+            if fetch(port, "/", timeout=1)[0] == 200:
+                return
+        except OSError:
+            sleep(0.1)
+    raise RuntimeError(f"lab3 did not start listening on port {port}")
+
+##################################
+# Older lab3 builds              #
+##################################
+
+# Older builds of lab3.py (back to the original) don't read every LAB3_*
+# variable above: they run the whois binary, resolve with the system
+# resolver, call the real https:// Census and weather.gov URLs, and listen
+# on port 5000. For each override a build lacks, bench_lab3 points that
+# call at the fakes from outside: a fake whois binary first on PATH, and a
+# sitecustomize module (imported by Python at startup) that sends *.bench
+# names to the fake DNS server and rewrites the real URLs.
+
+FAKE_WHOIS_BINARY = """
+from os import environ
+from socket import create_connection
+from sys import argv, stdout
+
+host, _, port = environ["BENCH_WHOIS_SERVER"].rpartition(":")
+with create_connection((host, int(port)), timeout=30) as conn:
+    conn.sendall(argv[-1].encode() + b"\\r\\n")
+    while True:
+        data = conn.recv(4096)
+        if not data:
+            break
+        stdout.buffer.write(data)
+"""
+
+LEGACY_SITECUSTOMIZE = """
+import socket
+from os import environ
+from struct import pack, unpack_from
+
+if "BENCH_DNS_SERVER" in environ:
+    _getaddrinfo, _gethostbyname = socket.getaddrinfo, socket.gethostbyname
+
+    def bench_address(name):
+        # one A query to the fake DNS server
+        host, _, port = environ["BENCH_DNS_SERVER"].rpartition(":")
+        query = (pack("!HHHHHH", 1, 0x0100, 1, 0, 0, 0)
+                 + b"".join(bytes([len(l)]) + l.encode() for l in name.split(".")) + b"\\0"
+                 + pack("!HH", 1, 1))
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.settimeout(2)
+            try:
+                s.sendto(query, (host, int(port)))
+                reply = s.recv(512)
+            except socket.timeout:
+                raise socket.gaierror(socket.EAI_AGAIN, "Temporary failure in name resolution") from None
+        if reply[3] & 0x0F or not unpack_from("!H", reply, 6)[0]:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return socket.inet_ntoa(reply[-4:])
+
+    def getaddrinfo(host, *args, **kwargs):
+        if isinstance(host, str) and host.endswith(".bench"):
+            host = bench_address(host)
+        return _getaddrinfo(host, *args, **kwargs)
+
+    def gethostbyname(host):
+        return bench_address(host) if host.endswith(".bench") else _gethostbyname(host)
+
+    socket.getaddrinfo, socket.gethostbyname = getaddrinfo, gethostbyname
+
+if "BENCH_CENSUS_URL" in environ:
+    REWRITES = [("https://geocoding.geo.census.gov/geocoder", environ["BENCH_CENSUS_URL"]),
+                ("https://api.weather.gov", environ["BENCH_WEATHER_URL"])]
+
+    def local_url(url):
+        for real, fake in REWRITES:
+            if str(url).startswith(real):
+                return fake + str(url)[len(real):]
+        return url
+
+    import requests
+    _request = requests.Session.request
+    requests.Session.request = lambda self, method, url, *a, **kw: _request(self, method, local_url(url), *a, **kw)
+    try:
+        import httpx
+    except ImportError:
+        pass
+    else:
+        _build_request = httpx.AsyncClient.build_request
+        httpx.AsyncClient.build_request = lambda self, method, url, **kw: _build_request(self, method, local_url(url), **kw)
+"""
+
+def legacy_env(source: str, tmp: str, upstreams: Upstreams) -> dict:
+    """Environment additions standing in for the LAB3_* overrides a build doesn't read."""
+    env = {}
+    if "LAB3_WHOIS_SERVER" not in source:
+        with open(join(tmp, "whois"), "w") as f:
+            f.write(f"#!{executable} -S" + FAKE_WHOIS_BINARY)  # -S: skip the sitecustomize below
+        chmod(join(tmp, "whois"), 0o755)
+        env["BENCH_WHOIS_SERVER"] = upstreams.address("whois")
+        env["PATH"] = tmp + pathsep + environ.get("PATH", "")
+    if "LAB3_DNS_SERVER" not in source:
+        env["BENCH_DNS_SERVER"] = upstreams.address("dns")
+    if "LAB3_CENSUS_URL" not in source:
+        env["BENCH_CENSUS_URL"] = f"http://{upstreams.address('census')}/geocoder"
+        env["BENCH_WEATHER_URL"] = f"http://{upstreams.address('weather')}"
+    if "BENCH_DNS_SERVER" in env or "BENCH_CENSUS_URL" in env:
+        with open(join(tmp, "sitecustomize.py"), "w") as f:
+            f.write(LEGACY_SITECUSTOMIZE)
+        env["PYTHONPATH"] = tmp + pathsep + environ.get("PYTHONPATH", "")
+    return env
+
+
+def bench_lab3(args, upstreams: Upstreams) -> dict:
+    with open(args.lab3) as f:
+        source = f.read()
+    # builds before LAB3_PORT always listen on Flask's default port
+    port = args.port if "LAB3_PORT" in source else 5000
+    cmd = [executable, abspath(args.lab3)] + (["--asgi"] if args.asgi else [])
+    with TemporaryDirectory() as tmp:
+        env = environ | upstreams.lab3_env() | {"LAB3_PORT": str(port)} | legacy_env(source, tmp, upstreams)
+        proc = Popen(cmd, cwd=tmp, env=env, stdout=DEVNULL, stderr=DEVNULL)
+        try:
+            wait_until_up(port, proc)
+            before = cache_counters(port)
+            result = drive(port, schedule(args.rate, args.duration, args.mix, args.domains,
+                                          args.zipf, args.seed), args.concurrency)
+            result["cache_hit_rate"] = hit_rates(before, cache_counters(port))
+        finally:
+            proc.terminate()
+            proc.wait()
+    return result
+
+
+def bench_lab2(args, upstreams: Upstreams) -> dict:
+    """
+    Run the lab2 CLI start to finish, --concurrency copies at a time. lab2
+    resolves with the system resolver, so every run looks up localhost; the
+    fake whois server answers for 127.0.0.1 like any other address.
+    """
+    times, failures = [], 0
+    lock = Lock()
+    with TemporaryDirectory() as tmp:
+        env = environ | upstreams.lab2_env() | {
+            name: "" if args.no_cache else join(tmp, f"{name.lower()}.json")
+            for name in ("LAB2_GEOCODE_CACHE", "LAB2_POINTS_CACHE", "LAB2_HOURLY_CACHE")
+        }
+        remaining = list(range(args.runs))
+
+        def worker():
+            nonlocal failures
+            while True:
+                with lock:
+                    if not remaining:
+                        return
+                    remaining.pop()
+                start = perf_counter()
+                proc = Popen([executable, abspath(args.lab2), "localhost"], cwd=tmp, env=env,
+                             stdout=PIPE, stderr=PIPE)
+                out, _ = proc.communicate()
+                elapsed = perf_counter() - start
+                with lock:
+                    times.append(elapsed)
+                    if proc.returncode != 0 or b"[5]" not in out:
+                        failures += 1
+
+        start = perf_counter()
+        workers = [Thread(target=worker) for _ in range(args.concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = perf_counter() - start
+    return {
+        "runs": args.runs,
+        "elapsed_s": round(elapsed, 2),
+        "runs_per_s": round(args.runs / elapsed, 2) if elapsed else 0.0,
+        "errors": failures,
+        "latency_ms": summarize(times),
+    }
+
+
+##################################
+# Reporting                      #
+##################################
+
+def print_report(label: str, result: dict):
+    print(f"== {label} ==")
+    lat = result["latency_ms"]
+    if "requests" in result:
+        print(f"requests:    {result['requests']} in {result['elapsed_s']} s "
+              f"({result['throughput_rps']} req/s), errors: {result['errors']} {result['status']}")
+    else:
+        print(f"runs:        {result['runs']} in {result['elapsed_s']} s "
+              f"({result['runs_per_s']} runs/s), errors: {result['errors']}")
+    print(f"latency ms:  p50 {lat['p50']}  p90 {lat['p90']}  p99 {lat['p99']}  max {lat['max']}")
+    for route, r in result.get("route_latency_ms", {}).items():
+        print(f"  {route:8s}   p50 {r['p50']}  p90 {r['p90']}  p99 {r['p99']}  max {r['max']}")
+    if result.get("cache_hit_rate"):
+        print("hit rate:    " + "  ".join(f"{k} {v:.1%}" for k, v in result["cache_hit_rate"].items()))
+    print("upstream:    " + "  ".join(f"{k} {v['requests']} ({v['errors']} failed)"
+                                      for k, v in result["upstream"].items()))
+
+
+def parse_fault(spec: str):
+    """'whois:200:0.05' -> ('whois', latency_ms, error_rate)."""
+    name, _, rest = spec.partition(":")
+    latency, _, errors = rest.partition(":")
+    return name, float(latency or 0), float(errors or 0)
+
+def main():
+    parser = ArgumentParser(description="Load test lab3 (or lab2) against local fake upstreams.")
+    parser.add_argument("--target", choices=("lab3", "lab2"), default="lab3")
+    parser.add_argument("--lab3", default=join(HERE, "lab3.py"), help="lab3.py build to test")
+    parser.add_argument("--lab2", default=join(HERE, "..", "Lab2", "lab2.py"), help="lab2.py build to test")
+    parser.add_argument("--asgi", action="store_true", help="serve lab3 in async mode")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--rate", type=float, default=50, help="requests per second")
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=32, help="client threads (lab2: processes)")
+    parser.add_argument("--domains", type=int, default=500, help="distinct siteN.bench domains")
+    parser.add_argument("--zipf", type=float, default=1.1, help="domain popularity skew")
+    parser.add_argument("--mix", type=parse_mix, default="address=4,weather=3,range=3")
+    parser.add_argument("--runs", type=int, default=10, help="lab2: number of CLI runs")
+    parser.add_argument("--no-cache", action="store_true", help="lab2: turn the JSON caches off")
+    parser.add_argument("--latency", type=float, default=20, help="ms added by every fake upstream")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of failed upstream calls")
+    parser.add_argument("--fault", action="append", default=[], metavar="NAME:MS[:RATE]",
+                        help="per-upstream override, NAME in dns/whois/census/weather")
+    parser.add_argument("--seed", type=int, default=330)
+    parser.add_argument("--label", default=None, help="name for this build in the report")
+    parser.add_argument("--json", metavar="FILE", help="append the result as one JSON line")
+    args = parser.parse_args()
+
+    faults = {name: Fault(args.latency, args.error_rate) for name in ("dns", "whois", "census", "weather")}
+    faults["dns"] = Fault(min(args.latency, 5), 0)  # DNS is local; keep it cheap unless asked
+    for spec in args.fault:
+        name, latency, errors = parse_fault(spec)
+        if name not in faults:
+            parser.error(f"unknown upstream {name!r}")
+        faults[name] = Fault(latency, errors)
+
+    upstreams = Upstreams(faults)
+    try:
+        if args.target == "lab3":
+            result = bench_lab3(args, upstreams)
+        else:
+            result = bench_lab2(args, upstreams)
+    finally:
+        upstreams.close()
+    result["upstream"] = upstreams.counts()
+
+    label = args.label or (args.lab3 if args.target == "lab3" else args.lab2)
+    print_report(label, result)
+    if args.json:
+        config = {k: getattr(args, k) for k in ("target", "asgi", "rate", "duration", "concurrency",
+                                               "domains", "zipf", "latency", "error_rate", "fault")}
+        with open(args.json, "a") as fh:
+            fh.write(dumps({"label": label, "config": config, **result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# author: Joel Sivanish
+#
+# Benchmark for lab3's single-pass whois parser.
+# Compares parse_whois() against the per-field scans it replaced
+# (extract_address + extract_range from lab3, the origin AS scan from lab7),
+# over the saved ARIN/RIPE/APNIC/LACNIC responses in whois_corpus/.
+#
+# Usage: python3 bench_whois.py [corpus_dir] [rounds]
+
+from os import environ, listdir
+from os.path import dirname, join
+from sys import argv
+from time import perf_counter
+
+# don't create the server's on-disk cache just to benchmark the parser
+environ.setdefault("LAB3_DB", "")
+
+from lab3 import parse_whois
+
+
+#########################################
+# Previous parsers, kept for comparison #
+#########################################
+
+def legacy_extract_address(whois_text: str) -> str:
+    lines = [l.strip() for l in whois_text.splitlines()]
+    street = city = state = postal = None
+    for l in lines:
+        if ":" not in l:
+            continue
+        k, v = l.split(":", 1)
+        key = k.strip().lower()
+        val = v.strip()
+        if key in ("address", "street", "street address", "orgaddress"):
+            street = (street + " " + val).strip() if street else val
+        elif key in ("city", "orgcity"):
+            city = val
+        elif key in ("state", "state/province", "orgstateprov"):
+            state = val
+        elif key in ("postalcode", "zipcode", "zip", "orgpostalcode"):
+            postal = val
+    parts = []
+    if street:
+        parts.append(street)
+    city_state_zip_parts = [p for p in (city, state, postal) if p]
+    if city_state_zip_parts:
+        parts.append(", ".join(city_state_zip_parts))
+    if parts:
+        return ", ".join(parts)
+    for l in lines:
+        if "address:" in l.lower():
+            return l.split(":", 1)[1].strip()
+    return "Address not found"
+
+def legacy_extract_range(whois_text: str):
+    for l in whois_text.splitlines():
+        if ":" not in l:
+            continue
+        k, v = l.split(":", 1)
+        key = k.strip().lower()
+        if key in ("netrange", "inetnum"):
+            return v.strip()
+    return "Range not found"
+
+def legacy_origin_as(whois_text: str):
+    for line in whois_text.splitlines():
+        lower = line.lower()
+        if "origin" in lower:
+            for token in line.replace(":", " ").split():
+                if token.upper().startswith("AS") and token[2:].isdigit():
+                    return token.upper()
+                if token.isdigit():
+                    return "AS" + token
+    return None
+
+def legacy_parse(whois_text: str):
+    return legacy_extract_address(whois_text), legacy_extract_range(whois_text), legacy_origin_as(whois_text)
+
+def single_pass_parse(whois_text: str):
+    # bypass parse_whois's per-text cache so every call really parses
+    record = parse_whois.__wrapped__(whois_text)
+    return record.address(), record.net_range or "Range not found", record.origin_as
+
+
+def records_per_second(parse, corpus: list, rounds: int) -> float:
+    start = perf_counter()
+    for _ in range(rounds):
+        for text in corpus:
+            parse(text)
+    return rounds * len(corpus) / (perf_counter() - start)
+
+
+def main():
+    corpus_dir = argv[1] if len(argv) > 1 else join(dirname(__file__) or ".", "whois_corpus")
+    rounds = int(argv[2]) if len(argv) > 2 else 2000
+
+    names = sorted(listdir(corpus_dir))
+    corpus = []
+    for name in names:
+        with open(join(corpus_dir, name), encoding="utf-8") as fh:
+            corpus.append(fh.read())
+
+    print(f"{len(corpus)} responses x {rounds} rounds from {corpus_dir}")
+    for name, text in zip(names, corpus):
+        old, new = legacy_parse(text), single_pass_parse(text)
+        note = "" if old == new else f"   (was {old})"
+        print(f"  {name}: {new}{note}")
+
+    old_rate = records_per_second(legacy_parse, corpus, rounds)
+    new_rate = records_per_second(single_pass_parse, corpus, rounds)
+    print(f"legacy (3 scans):  {old_rate:12,.0f} records/s")
+    print(f"parse_whois:       {new_rate:12,.0f} records/s")
+    print(f"speedup:           {new_rate / old_rate:12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,1500 @@
 #!/usr/bin/env python3
 # author: Joel Sivanish
 
-from flask import Flask
-from json import loads
-from requests import get
-from socket import gethostbyname
-from subprocess import getstatusoutput
+from asyncio import (
+    FIRST_COMPLETED as ASYNC_FIRST_COMPLETED,
+    Semaphore,
+    TimeoutError as AsyncTimeoutError,
+    as_completed as async_as_completed,
+    ensure_future,
+    get_running_loop,
+    open_connection,
+    shield,
+    wait as async_wait,
+    wait_for,
+)
+from bisect import bisect_left, bisect_right
+from array import array
+from collections import Counter, OrderedDict
+from csv import reader as csv_reader, writer as csv_writer
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    TimeoutError as FuturesTimeoutError,
+    as_completed,
+    wait as futures_wait,
+)
+from contextvars import ContextVar, copy_context
+from flask import Flask, Response, request
+from functools import lru_cache, wraps
+from hashlib import blake2b
+from heapq import heappop, heappush, merge as heap_merge
+from io import StringIO
+from ipaddress import IPv4Address, IPv6Address, ip_address, ip_network
+from json import dumps, loads
+from re import compile as re_compile
+from os import environ, listdir, pathsep, stat
+from os.path import isdir, join
+from random import getrandbits
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout as RequestsTimeout
+from sqlite3 import DatabaseError, connect
+from socket import (
+    AF_INET,
+    AF_INET6,
+    EAI_NONAME,
+    IPPROTO_TCP,
+    SOCK_DGRAM,
+    create_connection,
+    gaierror,
+    getaddrinfo,
+    socket,
+)
+from struct import pack, unpack_from
+from sys import argv
+from threading import Event, Lock, Thread, Timer, local
+from time import monotonic, perf_counter, time
+from typing import NamedTuple
+from urllib.parse import urlsplit
 
 app = Flask(__name__)
 
-# simple in-memory cache: keys are (route_name, domain)
-cache = {}
+#################
+# Result cache  #
+#################
+
+# Max number of (route, domain) results kept in memory before LRU eviction.
+CACHE_MAXSIZE = int(environ.get("LAB3_CACHE_SIZE", "4096"))
+
+# Per-route lifetimes in seconds. whois-derived data (address, range) barely
+# changes, forecasts go stale quickly.
+ROUTE_TTLS = {
+    "address": 24 * 60 * 60,
+    "range": 24 * 60 * 60,
+    "weather": 30 * 60,
+}
+
+
+_MISSING = object()
+
+
+class _Call:
+    """One in-flight computation that other threads can wait on."""
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function, everyone who arrives while it is running waits for and shares
+    its result (or its exception). A waiter gives up when its own request
+    deadline runs out, and if the leader's deadline ran out first, a waiter
+    with time left runs the function itself instead of sharing that.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}  # key -> _Call
+        self.coalesced = 0
+
+    def do(self, key, func):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _Call()
+                    self._calls[key] = call
+                else:
+                    self.coalesced += 1
+            if leader:
+                break
+            if not call.done.wait(deadline_left()):
+                raise DeadlineExceeded("time budget spent waiting for a shared lookup")
+            if call.error is None:
+                return call.value
+            if not shares_failure(call.error):
+                continue  # only the leader's budget ran out; try again with ours
+            raise call.error
+
+        try:
+            call.value = func()
+            return call.value
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of SingleFlight: concurrent awaits for the same key
+    share one task. Only used from the event loop thread.
+    """
+
+    def __init__(self):
+        self._tasks = {}  # key -> Task
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        while True:
+            task = self._tasks.get(key)
+            leader = task is None
+            if leader:
+                task = ensure_future(factory())
+                self._tasks[key] = task
+                task.add_done_callback(lambda done: self._forget(key, done))
+            else:
+                self.coalesced += 1
+            try:
+                # shield so one cancelled client doesn't cancel the shared lookup
+                return await wait_for(shield(task), deadline_left())
+            except AsyncTimeoutError:
+                if task.done():
+                    raise  # the lookup's own timeout, not our wait's
+                raise DeadlineExceeded("time budget spent waiting for a shared lookup") from None
+            except DeadlineExceeded as e:
+                if leader or shares_failure(e):
+                    raise
+                # only the leader's budget ran out; try again with ours
+
+    def _forget(self, key, task):
+        # every waiter may have given up on the task (deadline), so retrieve
+        # its exception here or asyncio logs it as never retrieved
+        if not task.cancelled():
+            task.exception()
+        # a retry may already have put a newer task under the key
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache where every entry carries its own expiry time.
+    Once more than maxsize entries are stored, the least recently used one
+    is evicted. Expired entries are dropped lazily when they are looked up.
+    """
+
+    def __init__(self, maxsize: int, default_ttl: float = 300):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._flights = SingleFlight()
+        self._aflights = AsyncSingleFlight()
+
+    def get(self, key, default=None):
+        """Return the live value for key (marking it recently used) or default."""
+        entry = self.get_with_ttl(key)
+        return default if entry is None else entry[0]
+
+    def get_with_ttl(self, key):
+        """Return (value, seconds_left) for a live key, or None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            ttl_left = expires_at - monotonic()
+            if ttl_left <= 0:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value, ttl_left
+
+    def set(self, key, value, ttl: float = None):
+        """Store value under key for ttl seconds (default_ttl if not given)."""
+        if ttl is None:
+            ttl = self.default_ttl
+        with self._lock:
+            self._data[key] = (value, monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, func, ttl=None):
+        """
+        Return the cached value for key, or run func() to produce and store
+        it. Concurrent misses on the same key share a single func() call.
+        ttl may be a number or a function of the computed value.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        def compute():
+            # a flight for this key may have finished while we were queued
+            with self._lock:
+                entry = self._data.get(key)
+                if entry is not None and entry[1] > monotonic():
+                    return entry[0]
+            value = func()
+            self.set(key, value, ttl(value) if callable(ttl) else ttl)
+            return value
+
+        return self._flights.do(key, compute)
+
+    async def aget_or_compute(self, key, factory, ttl=None):
+        """Async get_or_compute: factory() returns a coroutine to await on a miss."""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        async def compute():
+            value = await factory()
+            self.set(key, value, ttl(value) if callable(ttl) else ttl)
+            return value
+
+        return await self._aflights.do(key, compute)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "coalesced": self._flights.coalesced + self._aflights.coalesced,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class ResultStore:
+    """
+    SQLite-backed copy of the route cache, so results survive restarts and
+    are shared by every worker process. WAL mode lets readers run alongside
+    a writer, and each thread opens its own connection. Expiry times are
+    stored as wall-clock timestamps so they stay valid across restarts.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = local()
+        with self._conn() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " route TEXT NOT NULL,"
+                " domain TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " PRIMARY KEY (route, domain))"
+            )
+
+    def _conn(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = connect(self.path, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, route: str, domain: str):
+        """Return (value, seconds_left) for a live entry, or None."""
+        now = time()
+        try:
+            row = self._conn().execute(
+                "SELECT value, expires_at FROM results"
+                " WHERE route = ? AND domain = ? AND expires_at > ?",
+                (route, domain, now),
+            ).fetchone()
+        except DatabaseError:
+            # a locked or broken store just behaves like a miss
+            return None
+        if row is None:
+            return None
+        return row[0], row[1] - now
+
+    def set(self, route: str, domain: str, value: str, ttl: float):
+        try:
+            with self._conn() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                    (route, domain, value, time() + ttl),
+                )
+        except DatabaseError:
+            pass
+
+    def load_into(self, target: TTLCache, limit: int) -> int:
+        """
+        Drop expired rows, then copy up to limit of the longest-lived
+        entries into an in-memory cache. Returns how many were loaded.
+        """
+        now = time()
+        with self._conn() as db:
+            db.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            rows = db.execute(
+                "SELECT route, domain, value, expires_at FROM results"
+                " ORDER BY expires_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        # insert shortest-lived first so the LRU order keeps the longest-lived
+        for route, domain, value, expires_at in reversed(rows):
+            target.set((route, domain), value, expires_at - now)
+        return len(rows)
+
+
+# Stale-while-revalidate: once a route result is older than its ROUTE_TTLS
+# entry it is still served, but a background refresh is started. Only past
+# the max age here does a request have to wait for fresh data.
+ROUTE_MAX_AGES = {
+    "weather": int(environ.get("LAB3_WEATHER_MAX_AGE", str(2 * 60 * 60))),
+}
+
+def route_storage_ttl(route: str) -> float:
+    """How long a route result is kept at all (its hard max age)."""
+    return max(ROUTE_MAX_AGES.get(route, 0), ROUTE_TTLS[route])
+
+def is_stale(route: str, ttl_left: float) -> bool:
+    """True once a result has outlived its fresh window (ROUTE_TTLS)."""
+    return ttl_left <= route_storage_ttl(route) - ROUTE_TTLS[route]
+
+
+# route result cache: keys are (route_name, domain)
+cache = TTLCache(CACHE_MAXSIZE)
+
+# Lookups that come back empty or fail are cached too, as typed failures
+# with their own short TTLs, so a bad or bot-generated domain costs a dict
+# lookup instead of re-running the whole pipeline on every hit.
+FAILURE_TTLS = {
+    "nxdomain": 5 * 60,        # the name has no A/AAAA records
+    "no_address": 60 * 60,     # whois had no usable address
+    "no_range": 60 * 60,       # whois had no NetRange/inetnum
+    "geocode_miss": 60 * 60,   # Census couldn't place the address
+    "upstream_error": 30,      # whois/Census/weather.gov failed
+    "deadline": 10,            # the request's time budget ran out
+    "circuit_open": 5,         # an upstream's circuit breaker is open
+}
+FAILURE_STATUS = {
+    "nxdomain": 404,
+    "no_address": 404,
+    "no_range": 404,
+    "geocode_miss": 404,
+    "upstream_error": 502,
+    "deadline": 504,
+    "circuit_open": 503,
+}
+
+
+class Failure(NamedTuple):
+    kind: str     # a FAILURE_TTLS key
+    message: str  # response body
+
+
+# (route, domain) -> Failure; NXDOMAIN is stored once per domain under
+# ("resolve", domain) since it sinks every route
+failed_lookups = TTLCache(CACHE_MAXSIZE, FAILURE_TTLS["upstream_error"])
+negative_results = Counter()  # kind -> failures cached
+
+
+class NoResult(Exception):
+    """Raised by a route computation that definitively found nothing."""
+
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+class LookupFailed(Exception):
+    """A (route, domain) lookup whose typed failure is cached."""
+
+    def __init__(self, failure: Failure, ttl_left: float):
+        super().__init__(failure.message)
+        self.failure = failure
+        self.ttl_left = ttl_left
+
+# On-disk store shared by all workers; set LAB3_DB="" to disable it. It is
+# opened (and preloaded into the memory cache) on first use, not at import.
+STORE_PATH = environ.get("LAB3_DB", "lab3_cache.db")
+store = None
+store_opened = False
+store_lock = Lock()
+
+def result_store():
+    """The on-disk store, or None if it is disabled or unusable."""
+    global store, store_opened
+    if store_opened:
+        return store
+    with store_lock:
+        if not store_opened:
+            if STORE_PATH:
+                try:
+                    opened = ResultStore(STORE_PATH)
+                    opened.load_into(cache, CACHE_MAXSIZE)
+                    store = opened
+                except DatabaseError as e:
+                    # a corrupt or foreign file: run as if the store were empty
+                    app.logger.warning("result store %s unusable, not using it: %s", STORE_PATH, e)
+            store_opened = True
+    return store
+
+#################
+# Metrics       #
+#################
+
+# Histogram bucket upper bounds in seconds, from a cache-speed DNS answer
+# up to a hung upstream.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (Prometheus style, cumulative on output)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = Lock()
+
+    def observe(self, seconds: float):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def render(self, name: str, labels: str) -> list:
+        """Prometheus text lines for this histogram; labels like 'stage="whois"'."""
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        lines = []
+        running = 0
+        for bound, n in zip(self.buckets + ("+Inf",), counts):
+            running += n
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {running}')
+        lines.append(f"{name}_sum{{{labels}}} {total}")
+        lines.append(f"{name}_count{{{labels}}} {count}")
+        return lines
+
+    def quantile(self, q: float):
+        """Estimated q-quantile in seconds (linear within a bucket), or None if empty."""
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        target = q * count
+        running, lower = 0, 0.0
+        for bound, n in zip(self.buckets, counts):
+            if n and running + n >= target:
+                return lower + (bound - lower) * (target - running) / n
+            running += n
+            lower = bound
+        return self.buckets[-1]  # in the +Inf bucket: the largest finite bound
+
+
+class StageMetrics:
+    """Latency histogram, in-flight gauge and error counter for one upstream stage."""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.inflight = 0
+        self.errors = 0
+        self._lock = Lock()
+
+    @contextmanager
+    def track(self):
+        with self._lock:
+            self.inflight += 1
+        start = perf_counter()
+        try:
+            yield
+        except BaseException:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            self.latency.observe(perf_counter() - start)
+            with self._lock:
+                self.inflight -= 1
+
+
+# stage name -> StageMetrics (resolve, whois, geocode, points, forecast)
+stage_metrics = {}
+
+# route name -> end-to-end request latency, cache hits included
+route_latency = {}
+
+def track(stage: str):
+    """Context manager timing one upstream call, e.g. `with track("whois"):`."""
+    metrics = stage_metrics.get(stage)
+    if metrics is None:
+        metrics = stage_metrics.setdefault(stage, StageMetrics())
+    return metrics.track()
+
+def observe_route(route: str, seconds: float):
+    hist = route_latency.get(route)
+    if hist is None:
+        hist = route_latency.setdefault(route, Histogram())
+    hist.observe(seconds)
+
+#########################
+# Deadline budgets      #
+#########################
+
+# Every route request gets a total time budget. Each upstream call in its
+# pipeline takes its timeout from what's left, holding back a little for
+# every stage still to come, so one slow stage can't use up the whole
+# budget and a stuck upstream can't hold a worker past the deadline.
+def parse_route_deadlines(spec: str) -> dict:
+    """'weather=2,address=1.5' -> {route: seconds}."""
+    deadlines = {}
+    for item in filter(None, (i.strip() for i in spec.split(","))):
+        route, _, seconds = item.partition("=")
+        deadlines[route] = float(seconds)
+    return deadlines
+
+ROUTE_DEADLINES = {
+    "address": 4.0,
+    "range": 4.0,
+    "weather": 8.0,
+} | parse_route_deadlines(environ.get("LAB3_DEADLINES", ""))
+
+# each route's upstream stages, in pipeline order
+ROUTE_STAGES = {
+    "address": ("resolve", "whois"),
+    "range": ("resolve", "whois"),
+    "weather": ("resolve", "whois", "geocode", "points", "forecast"),
+}
+
+# seconds of the budget kept back for a stage while earlier ones run
+STAGE_RESERVES = {"resolve": 0.1, "whois": 0.5, "geocode": 0.5, "points": 0.25, "forecast": 0.25}
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before a stage could finish."""
+
+
+class Deadline(NamedTuple):
+    expires_at: float  # monotonic() time
+    stages: tuple      # the route's ROUTE_STAGES
+
+
+# deadline of the request the current thread / task is serving (None for
+# warm-up and background work), and the pipeline stage it's in
+request_deadline = ContextVar("request_deadline", default=None)
+current_stage = ContextVar("current_stage", default=None)
+
+@contextmanager
+def deadline_scope(route: str):
+    """Give the block route's time budget."""
+    deadline = Deadline(monotonic() + ROUTE_DEADLINES[route], ROUTE_STAGES[route])
+    token = request_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        request_deadline.reset(token)
+
+@contextmanager
+def stage_scope(stage: str):
+    token = current_stage.set(stage)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+def deadline_left():
+    """Seconds left in the current request's budget (at least 0), or None without one."""
+    deadline = request_deadline.get()
+    return None if deadline is None else max(deadline.expires_at - monotonic(), 0)
+
+def shares_failure(e: Exception) -> bool:
+    """Whether a SingleFlight waiter should take the leader's exception as its own."""
+    return not isinstance(e, DeadlineExceeded) or deadline_expired()
+
+def deadline_expired() -> bool:
+    deadline = request_deadline.get()
+    return deadline is not None and monotonic() >= deadline.expires_at
+
+def stage_timeout(default: float) -> float:
+    """
+    Timeout for one upstream call: `default`, cut down to the request's
+    remaining budget minus reserves for the stages after this one (but never
+    below half of what's left). Raises DeadlineExceeded once it's spent.
+    """
+    deadline = request_deadline.get()
+    if deadline is None:
+        return default
+    left = deadline.expires_at - monotonic()
+    stage = current_stage.get()
+    if left <= 0:
+        raise DeadlineExceeded(f"time budget spent before {stage or 'an upstream call'}")
+    later = deadline.stages[deadline.stages.index(stage) + 1:] if stage in deadline.stages else ()
+    reserve = sum(STAGE_RESERVES[s] for s in later)
+    return min(default, max(left - reserve, left / 2))
+
+#########################
+# Upstream scheduler    #
+#########################
+
+# Every call to a whois server, Census or weather.gov first takes a slot
+# from that host's scheduler: at most `concurrency` calls in flight, new
+# calls paced by a token bucket (`rate` per second, bursts up to `burst`).
+# Queued callers are served best priority first, so warm-up and background
+# refreshes only get a slot when no live request is waiting for that host.
+PRIORITY_LIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_LIVE: "live", PRIORITY_BACKGROUND: "background"}
+
+# priority of upstream calls made by the current thread / task
+upstream_priority = ContextVar("upstream_priority", default=PRIORITY_LIVE)
+
+@contextmanager
+def background_priority():
+    """Run the block's upstream calls behind any live request's."""
+    token = upstream_priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        upstream_priority.reset(token)
+
+
+class UpstreamLimit(NamedTuple):
+    concurrency: int  # calls in flight at once
+    rate: float       # new calls per second; 0 means unpaced
+    burst: int        # token bucket size
+
+
+def parse_upstream_limits(spec: str) -> dict:
+    """'api.weather.gov=8/10/20,whois.ripe.net=2/1' -> {host: UpstreamLimit}."""
+    limits = {}
+    for item in filter(None, (i.strip() for i in spec.split(","))):
+        host, _, value = item.partition("=")
+        parts = value.split("/")
+        rate = float(parts[1]) if len(parts) > 1 else 0.0
+        burst = int(parts[2]) if len(parts) > 2 else max(1, int(rate))
+        limits[host] = UpstreamLimit(int(parts[0]), rate, burst)
+    return limits
+
+# per-host limits; LAB3_UPSTREAM_LIMITS adds or overrides hosts. An upstream
+# off its protocol's default port is its own host here, named "host:port"
+# (so local stand-ins sharing 127.0.0.1 don't share, or throttle, one slot pool).
+UPSTREAM_LIMITS = {
+    "geocoding.geo.census.gov": UpstreamLimit(8, 20, 40),
+    "api.weather.gov": UpstreamLimit(8, 10, 20),
+} | parse_upstream_limits(environ.get("LAB3_UPSTREAM_LIMITS", ""))
+WHOIS_DEFAULT_LIMIT = UpstreamLimit(4, 4, 8)  # any whois server not listed above
+HTTP_DEFAULT_LIMIT = UpstreamLimit(16, 0, 0)  # any other HTTP host (e.g. a local stand-in)
+# longest a call waits for a slot before failing as an upstream error
+UPSTREAM_QUEUE_TIMEOUT = float(environ.get("LAB3_UPSTREAM_QUEUE_TIMEOUT", "10"))
+
+
+class UpstreamBusy(Exception):
+    """No slot on an upstream host freed up within UPSTREAM_QUEUE_TIMEOUT."""
+
+
+class _Waiter:
+    """A queued acquire: a thread blocked on an Event or a task awaiting a future."""
+
+    def __init__(self, priority: int, loop=None):
+        self.priority = priority
+        self.granted = False
+        self.cancelled = False
+        self.loop = loop
+        self.event = None if loop else Event()
+        self.future = loop.create_future() if loop else None
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve_waiter, self.future)
+
+
+def _resolve_waiter(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class UpstreamScheduler:
+    """Concurrency cap + token bucket + priority queue for one upstream host."""
+
+    def __init__(self, host: str, limit: UpstreamLimit):
+        self.host = host
+        self.limit = limit
+        self.tokens = float(limit.burst)
+        self._stamp = monotonic()
+        self.active = 0
+        self.waiting = 0
+        self.timeouts = 0
+        self.wait = {p: Histogram() for p in PRIORITY_NAMES}  # queueing time by priority
+        self._queue = []  # heap of (priority, seq, _Waiter)
+        self._seq = 0
+        self._timer = None
+        self._lock = Lock()
+        self.breaker = CircuitBreaker(host)
+
+    def _can_start(self) -> bool:
+        if self.limit.rate:
+            now = monotonic()
+            self.tokens = min(self.limit.burst, self.tokens + (now - self._stamp) * self.limit.rate)
+            self._stamp = now
+        return self.active < self.limit.concurrency and (not self.limit.rate or self.tokens >= 1)
+
+    def _take(self):
+        self.active += 1
+        if self.limit.rate:
+            self.tokens -= 1
+
+    def _dispatch(self):
+        """Hand free slots to queued waiters, best priority first. Caller holds the lock."""
+        while self._queue and self._can_start():
+            waiter = heappop(self._queue)[2]
+            if waiter.cancelled:
+                continue
+            self._take()
+            self.waiting -= 1
+            waiter.grant()
+        if self.waiting and self.limit.rate and self.active < self.limit.concurrency and self._timer is None:
+            # only out of tokens: come back when the next one has dripped in
+            self._timer = Timer((1 - self.tokens) / self.limit.rate, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def _enqueue(self, priority: int, loop=None):
+        """Take a slot now (returns None) or queue up and return the _Waiter."""
+        with self._lock:
+            if not self.waiting and self._can_start():
+                self._take()
+                return None
+            waiter = _Waiter(priority, loop)
+            self._seq += 1
+            heappush(self._queue, (priority, self._seq, waiter))
+            self.waiting += 1
+            self._dispatch()
+            return waiter
+
+    def _give_up(self, waiter: _Waiter) -> bool:
+        """Withdraw a waiter that stopped waiting; False if it was granted meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiter.cancelled = True
+            self.waiting -= 1
+            return True
+
+    def _busy(self, timeout: float) -> UpstreamBusy:
+        with self._lock:
+            self.timeouts += 1
+        return UpstreamBusy(f"{self.host}: no free slot after {timeout:g}s")
+
+    def acquire(self, priority: int = PRIORITY_LIVE, timeout: float = UPSTREAM_QUEUE_TIMEOUT):
+        start = perf_counter()
+        waiter = self._enqueue(priority)
+        if waiter is not None and not waiter.event.wait(timeout):
+            if self._give_up(waiter):
+                raise self._busy(timeout)
+        self.wait[priority].observe(perf_counter() - start)
+
+    async def acquire_async(self, priority: int = PRIORITY_LIVE, timeout: float = UPSTREAM_QUEUE_TIMEOUT):
+        start = perf_counter()
+        waiter = self._enqueue(priority, get_running_loop())
+        if waiter is not None:
+            try:
+                await wait_for(shield(waiter.future), timeout)
+            except AsyncTimeoutError:
+                if self._give_up(waiter):
+                    raise self._busy(timeout) from None
+            except BaseException:
+                # cancelled: leave the queue, or hand back a slot granted meanwhile
+                if not self._give_up(waiter):
+                    self.release()
+                raise
+        self.wait[priority].observe(perf_counter() - start)
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+            self._dispatch()
+
+
+# An upstream that keeps failing is skipped for a while instead of making
+# every request wait out its timeout: after BREAKER_THRESHOLD failures in a
+# row its circuit opens and calls fail at once. After BREAKER_COOLDOWN
+# seconds one probe call is let through, and its success closes the circuit.
+BREAKER_THRESHOLD = int(environ.get("LAB3_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(environ.get("LAB3_BREAKER_COOLDOWN", "30"))
+
+
+class CircuitOpen(Exception):
+    """The upstream's circuit breaker is open; the call wasn't attempted."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one upstream host."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.failures = 0       # consecutive
+        self.opened_at = None   # monotonic() time, None while closed
+        self.probe_at = None    # when the half-open probe was let through
+        self.trips = 0
+        self.rejected = 0
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self):
+        """Return if a call may go ahead, else raise CircuitOpen."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            now = monotonic()
+            if now - self.opened_at >= BREAKER_COOLDOWN and (
+                    self.probe_at is None or now - self.probe_at >= BREAKER_COOLDOWN):
+                self.probe_at = now  # half-open: this call is the probe
+                return
+            self.rejected += 1
+        raise CircuitOpen(f"{self.host} is failing; not calling it for up to {BREAKER_COOLDOWN:g}s")
+
+    def record(self, ok: bool):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = self.probe_at = None
+                return
+            self.failures += 1
+            if self.opened_at is None and self.failures >= BREAKER_THRESHOLD:
+                self.trips += 1
+                self.opened_at = monotonic()
+            elif self.opened_at is not None:
+                # a failed probe keeps it open for another cooldown
+                self.opened_at = monotonic()
+                self.probe_at = None
+
+def upstream_name(host: str, port, default_port: int) -> str:
+    """Scheduler key for an upstream: 'host', or 'host:port' when off default_port."""
+    return host if port in (None, default_port) else f"{host}:{port}"
+
+def http_upstream(url: str) -> str:
+    parts = urlsplit(url)
+    return upstream_name(parts.hostname, parts.port, 443 if parts.scheme == "https" else 80)
+
+# upstream name -> UpstreamScheduler, created on first use. Each name is one
+# host and port, so one protocol: whois calls always bring WHOIS_DEFAULT_LIMIT
+# and HTTP calls HTTP_DEFAULT_LIMIT as the default for an unlisted name.
+upstream_schedulers = {}
+upstream_schedulers_lock = Lock()
+
+def upstream_scheduler(host: str, default: UpstreamLimit) -> UpstreamScheduler:
+    scheduler = upstream_schedulers.get(host)
+    if scheduler is None:
+        with upstream_schedulers_lock:
+            scheduler = upstream_schedulers.get(host)
+            if scheduler is None:
+                scheduler = UpstreamScheduler(host, UPSTREAM_LIMITS.get(host, default))
+                upstream_schedulers[host] = scheduler
+    return scheduler
+
+class CallBudget:
+    """
+    Timeouts for one upstream call, remembering whether the request's budget
+    made any of them shorter than the call's own default.
+    """
+
+    def __init__(self, host: str):
+        self.host = host
+        self.cut = False
+
+    def timeout(self, default: float) -> float:
+        timeout = stage_timeout(default)
+        self.cut = self.cut or timeout < default
+        return timeout
+
+    def timed_out(self, e: Exception):
+        """DeadlineExceeded for a timeout our budget caused, else None."""
+        if self.cut and isinstance(e, (TimeoutError, AsyncTimeoutError, RequestsTimeout, UpstreamBusy)):
+            return DeadlineExceeded(f"{self.host}: out of time budget ({type(e).__name__}: {e})")
+        return None
+
+
+def upstream_failed(scheduler: UpstreamScheduler, call: CallBudget, e: Exception):
+    """Account for an exception from the slot's block, re-raising what the caller should see."""
+    if isinstance(e, DeadlineExceeded):
+        raise e  # our budget ran out; says nothing about the upstream
+    budget_spent = call.timed_out(e)
+    if budget_spent is not None:
+        # the upstream only had the budget's leftovers; not its fault
+        raise budget_spent from e
+    scheduler.breaker.record(False)
+    raise e
+
+@contextmanager
+def upstream_slot(host: str, default: UpstreamLimit = HTTP_DEFAULT_LIMIT, timeout: float = UPSTREAM_QUEUE_TIMEOUT):
+    """
+    Hold one of host's slots for the block, e.g.
+    `with upstream_slot("api.weather.gov") as call: get(url, timeout=call.timeout(10))`.
+    host is an upstream_name(), i.e. "host:port" for a non-default port.
+    Fails fast while host's circuit is open; an exception in the block counts
+    against it, unless it is a timeout cut short by the request's deadline
+    (that is raised as DeadlineExceeded).
+    """
+    scheduler = upstream_scheduler(host, default)
+    scheduler.breaker.allow()
+    call = CallBudget(host)
+    try:
+        scheduler.acquire(upstream_priority.get(), call.timeout(timeout))
+    except UpstreamBusy as e:
+        raise call.timed_out(e) or e
+    call.cut = False  # the queue wait's cut isn't the call's
+    try:
+        yield call
+    except Exception as e:
+        upstream_failed(scheduler, call, e)
+    else:
+        scheduler.breaker.record(True)
+    finally:
+        scheduler.release()
+
+@asynccontextmanager
+async def upstream_slot_async(host: str, default: UpstreamLimit = HTTP_DEFAULT_LIMIT):
+    scheduler = upstream_scheduler(host, default)
+    scheduler.breaker.allow()
+    call = CallBudget(host)
+    try:
+        await scheduler.acquire_async(upstream_priority.get(), call.timeout(UPSTREAM_QUEUE_TIMEOUT))
+    except UpstreamBusy as e:
+        raise call.timed_out(e) or e
+    call.cut = False
+    try:
+        yield call
+    except Exception as e:
+        upstream_failed(scheduler, call, e)
+    else:
+        scheduler.breaker.record(True)
+    finally:
+        scheduler.release()
+
+# Lifetimes for the intermediate pipeline stages, in seconds.
+STAGE_TTLS = {
+    "resolve": 5 * 60,
+    "whois": 24 * 60 * 60,
+    "geocode": 7 * 24 * 60 * 60,
+    "points": 30 * 24 * 60 * 60,
+    "forecast": 30 * 60,
+}
+
+# one cache per pipeline stage, keyed by that stage's own input
+stage_caches = {}
+
+def cached_stage(name: str, key=None, ttl=None):
+    """
+    Decorator that memoizes a pipeline stage (domain -> ip, ip -> whois, ...)
+    in its own TTLCache, keyed by the stage's arguments. Every route that
+    reaches the same intermediate input shares the stored result.
+    key(*args) can fold equivalent inputs onto one cache key, and ttl(value)
+    can give some results (e.g. misses) a different lifetime.
+    """
+    stage_cache = TTLCache(CACHE_MAXSIZE, STAGE_TTLS[name])
+    stage_caches[name] = stage_cache
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            def compute():
+                with track(name), stage_scope(name):
+                    return func(*args)
+            return stage_cache.get_or_compute(key(*args) if key else args, compute, ttl)
+        wrapper.cache = stage_cache
+        return wrapper
+    return decorator
+
+
+def async_cached_stage(name: str, key=None, ttl=None):
+    """
+    Async version of cached_stage. It stores into the same stage cache as the
+    sync function of that name, so both serving modes share results; pass
+    the same key/ttl functions as the sync stage.
+    """
+    stage_cache = stage_caches[name]
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args):
+            async def compute():
+                with track(name), stage_scope(name):
+                    return await func(*args)
+            return await stage_cache.aget_or_compute(key(*args) if key else args, compute, ttl)
+        wrapper.cache = stage_cache
+        return wrapper
+    return decorator
 
 ########################################
 # Helper functions (adapted from lab2) #
 ########################################
 
+##################
+# DNS resolver   #
+##################
+
+# Instead of gethostbyname (blocking, one IPv4 address, no TTL) we send our
+# own A and AAAA queries together over UDP to the system's nameserver and
+# cache the answer for as long as its records' TTL says. If the nameserver
+# can't be used (timeout, truncation, SERVFAIL, no resolv.conf) we fall back
+# to getaddrinfo with a short fixed TTL.
+DNS_SERVER = environ.get("LAB3_DNS_SERVER")  # "host[:port]", default from /etc/resolv.conf
+DNS_PORT = 53
+DNS_TIMEOUT = 2.0
+DNS_MIN_TTL = 5
+DNS_MAX_TTL = 24 * 60 * 60
+DNS_FALLBACK_TTL = 60
+DNS_FALLBACK_TIMEOUT = 10.0  # getaddrinfo, cut down to the request's budget
+DNS_A, DNS_AAAA = 1, 28
+DNS_NXDOMAIN = 3
+
+dns_fallbacks = 0
+
+
+class DnsAnswer(NamedTuple):
+    addresses: tuple  # IPv4 first, then IPv6
+    ttl: float
+
+
+class DnsUnavailable(Exception):
+    """The nameserver didn't give a usable answer; use getaddrinfo instead."""
+
+
+class DnsNameError(gaierror):
+    """NXDOMAIN from the nameserver; getaddrinfo still gets a try (search domains)."""
+
+
+# The hosts file is checked before any query, as getaddrinfo would, so
+# localhost and the machine's own name resolve the same as with
+# gethostbyname. Parsed again only when its mtime changes.
+HOSTS_FILE = "/etc/hosts"
+hosts_cache = (None, {})  # (mtime, name -> addresses)
+
+def read_hosts(path: str) -> dict:
+    """Hosts file -> {lowercased name: (addresses, IPv4 first)}."""
+    names = {}
+    with open(path, encoding="utf-8", errors="replace") as fh:
+        for l in fh:
+            parts = l.split("#", 1)[0].split()
+            if len(parts) < 2:
+                continue
+            try:
+                addr = ip_address(parts[0].split("%")[0])
+            except ValueError:
+                continue
+            for name in parts[1:]:
+                names.setdefault(name.lower().rstrip("."), []).append(addr)
+    return {name: tuple(dict.fromkeys(str(a) for a in sorted(addrs, key=lambda a: a.version)))
+            for name, addrs in names.items()}
+
+def hosts_answer(domain: str):
+    """DnsAnswer from the hosts file, or None if it doesn't list domain."""
+    global hosts_cache
+    try:
+        mtime = stat(HOSTS_FILE).st_mtime
+        if mtime != hosts_cache[0]:
+            hosts_cache = (mtime, read_hosts(HOSTS_FILE))
+    except OSError:
+        return None
+    addresses = hosts_cache[1].get(domain.lower().rstrip("."))
+    return DnsAnswer(addresses, DNS_FALLBACK_TTL) if addresses else None
+
+def needs_system_resolver(domain: str) -> bool:
+    # single-label names only resolve via resolv.conf search domains, which
+    # the stub resolver doesn't apply; leave them to getaddrinfo
+    return "." not in domain.rstrip(".")
+
+
+def dns_server():
+    """(host, port) of the nameserver to query, or None."""
+    server = DNS_SERVER
+    if server is None:
+        try:
+            with open("/etc/resolv.conf") as fh:
+                for l in fh:
+                    parts = l.split()
+                    if len(parts) >= 2 and parts[0] == "nameserver":
+                        server = parts[1]
+                        break
+        except OSError:
+            return None
+    if not server:
+        return None
+    if server.count(":") == 1:  # "host:port" (a bare IPv6 address has several colons)
+        host, port = server.split(":")
+        return host, int(port)
+    return server, DNS_PORT
+
+
+def dns_query(qid: int, domain: str, qtype: int) -> bytes:
+    """A recursion-desired query packet for one name and record type."""
+    labels = domain.rstrip(".").encode("idna").split(b".")
+    qname = b"".join(bytes([len(l)]) + l for l in labels) + b"\0"
+    return pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0) + qname + pack("!HH", qtype, 1)
+
+
+def skip_dns_name(data: bytes, off: int) -> int:
+    while True:
+        n = data[off]
+        if n == 0:
+            return off + 1
+        if n & 0xC0 == 0xC0:  # compression pointer ends the name
+            return off + 2
+        off += 1 + n
+
+
+def parse_dns_response(data: bytes):
+    """-> (id, rcode, [(address, ttl), ...]) keeping only A/AAAA answers."""
+    qid, flags, qdcount, ancount, _, _ = unpack_from("!HHHHHH", data)
+    if flags & 0x0200:
+        raise DnsUnavailable("truncated response")
+    off = 12
+    for _ in range(qdcount):
+        off = skip_dns_name(data, off) + 4
+    answers = []
+    for _ in range(ancount):
+        off = skip_dns_name(data, off)
+        rtype, _, ttl, rdlength = unpack_from("!HHIH", data, off)
+        off += 10
+        rdata = data[off:off + rdlength]
+        off += rdlength
+        if rtype == DNS_A and rdlength == 4:
+            answers.append((str(IPv4Address(rdata)), ttl))
+        elif rtype == DNS_AAAA and rdlength == 16:
+            answers.append((str(IPv6Address(rdata)), ttl))
+    return qid, flags & 0xF, answers
+
+
+class DnsExchange:
+    """One A+AAAA lookup: the packets to send and the replies received so far."""
+
+    def __init__(self, domain: str):
+        self.domain = domain
+        self.pending = {getrandbits(16): DNS_A, getrandbits(16) | 1: DNS_AAAA}
+        if len(self.pending) < 2:  # both ids collided
+            self.pending = {0x1000: DNS_A, 0x1001: DNS_AAAA}
+        self.results = {}  # qtype -> (rcode, answers)
+
+    def packets(self):
+        return [dns_query(qid, self.domain, qtype) for qid, qtype in self.pending.items()]
+
+    def feed(self, data: bytes) -> bool:
+        """Take one datagram; True once both answers are in."""
+        qid, rcode, answers = parse_dns_response(data)
+        qtype = self.pending.pop(qid, None)
+        if qtype is not None:
+            self.results[qtype] = (rcode, answers)
+        return not self.pending
+
+    def answer(self) -> DnsAnswer:
+        rcodes = [rcode for rcode, _ in self.results.values()]
+        if rcodes and all(r == DNS_NXDOMAIN for r in rcodes):
+            raise DnsNameError(EAI_NONAME, f"{self.domain}: name does not exist")
+        if any(r not in (0, DNS_NXDOMAIN) for r in rcodes):
+            raise DnsUnavailable(f"rcode {rcodes}")
+        records = self.results.get(DNS_A, (0, []))[1] + self.results.get(DNS_AAAA, (0, []))[1]
+        if not records:
+            raise gaierror(EAI_NONAME, f"{self.domain}: no A/AAAA records")
+        addresses = tuple(dict.fromkeys(addr for addr, _ in records))
+        ttl = min(max(min(t for _, t in records), DNS_MIN_TTL), DNS_MAX_TTL)
+        return DnsAnswer(addresses, ttl)
+
+
+def dns_socket(server):
+    family = AF_INET6 if ":" in server[0] else AF_INET
+    sock = socket(family, SOCK_DGRAM)
+    sock.connect(server)
+    return sock
+
+
+def fallback_answer(infos) -> DnsAnswer:
+    global dns_fallbacks
+    dns_fallbacks += 1
+    v4 = [i[4][0] for i in infos if i[0] == AF_INET]
+    v6 = [i[4][0] for i in infos if i[0] == AF_INET6]
+    return DnsAnswer(tuple(dict.fromkeys(v4 + v6)), DNS_FALLBACK_TTL)
+
+
+# getaddrinfo can't be interrupted, so the threaded server waits for it on
+# a worker thread and stops waiting when the budget says so
+dns_fallback_pool = ThreadPoolExecutor(max_workers=8)
+
+def fallback_timed_out(domain: str, call: CallBudget) -> Exception:
+    """The error for a getaddrinfo fallback that didn't answer in time."""
+    if call.cut:
+        return DeadlineExceeded(f"no answer for {domain} from the system resolver within the time budget")
+    return OSError(f"no answer for {domain} from the system resolver within {DNS_FALLBACK_TIMEOUT:g}s")
+
+def system_resolve(domain: str) -> DnsAnswer:
+    """getaddrinfo, waited on no longer than stage_timeout allows."""
+    call = CallBudget("getaddrinfo")
+    timeout = call.timeout(DNS_FALLBACK_TIMEOUT)
+    future = dns_fallback_pool.submit(getaddrinfo, domain, None, proto=IPPROTO_TCP)
+    try:
+        return fallback_answer(future.result(timeout))
+    except FuturesTimeoutError:
+        raise fallback_timed_out(domain, call) from None
+
+def dns_resolve(domain: str) -> DnsAnswer:
+    """
+    Hosts file first, then send A and AAAA together and wait for both. Falls
+    back to getaddrinfo when the nameserver fails or says NXDOMAIN, and for
+    single-label names.
+    """
+    local = hosts_answer(domain)
+    if local is not None:
+        return local
+    server = dns_server()
+    try:
+        if server is None:
+            raise DnsUnavailable("no nameserver configured")
+        if needs_system_resolver(domain):
+            raise DnsUnavailable("single-label name")
+        exchange = DnsExchange(domain)
+        with dns_socket(server) as sock:
+            sock.settimeout(stage_timeout(DNS_TIMEOUT))
+            for packet in exchange.packets():
+                sock.send(packet)
+            while not exchange.feed(sock.recv(4096)):
+                pass
+        return exchange.answer()
+    except (DnsUnavailable, OSError, ValueError, IndexError) as e:
+        if isinstance(e, gaierror) and not isinstance(e, DnsNameError):
+            raise
+        if deadline_expired():
+            raise DeadlineExceeded(f"no DNS answer for {domain} within the time budget") from e
+        return system_resolve(domain)
+
+
+def resolve_key(domain: str) -> tuple:
+    # DNS names are case-insensitive and may carry a trailing dot
+    return (domain.lower().rstrip("."),)
+
+
+def dns_ttl(answer: DnsAnswer) -> float:
+    return answer.ttl
+
+
+@cached_stage("resolve", key=resolve_key, ttl=dns_ttl)
+def resolve_addresses(domain: str) -> DnsAnswer:
+    """All A/AAAA addresses for a domain, cached for the records' TTL."""
+    return dns_resolve(domain)
+
 def resolve_ip(domain: str) -> str:
-    """Domain -> IPv4 string using DNS A lookup."""
-    return gethostbyname(domain)
+    """Domain -> IP string (first A record, else first AAAA)."""
+    return resolve_addresses(domain).addresses[0]
+
+# whois is spoken directly over TCP port 43 instead of forking the whois
+# binary. Queries start at IANA (or the override below, as "host[:port]")
+# and follow refer:/ReferralServer: lines to the RIR holding the record.
+WHOIS_SERVER = environ.get("LAB3_WHOIS_SERVER", "whois.iana.org")
+WHOIS_PORT = 43
+WHOIS_TIMEOUT = 10
+WHOIS_MAX_REFERRALS = 3
+
+# first IPv4 octet -> RIR server IANA referred us to, so later lookups in
+# the same /8 skip the IANA round trip
+whois_referrals = {}
 
+def split_server(server: str):
+    """'host' or 'host:port' -> (host, port)."""
+    host, _, port = server.partition(":")
+    return host, int(port) if port.isdigit() else WHOIS_PORT
+
+def whois_query_line(server: str, ip: str) -> str:
+    # ARIN only returns the full network record for "n + <ip>"
+    if split_server(server)[0] == "whois.arin.net":
+        return f"n + {ip}"
+    return ip
+
+def whois_referral(whois_text: str):
+    """Return the next whois server named in a response, or None."""
+    for l in whois_text.splitlines():
+        if ":" not in l:
+            continue
+        k, v = l.split(":", 1)
+        key = k.strip().lower()
+        val = v.strip()
+        if key in ("refer", "whois") and val:
+            return val  # IANA style
+        if key == "referralserver" and val.startswith("whois://"):
+            return val[len("whois://"):].rstrip("/")  # ARIN style; rwhois:// is skipped
+    return None
+
+def next_whois_server(ip: str, server: str, whois_text: str):
+    """Where to ask next after server answered whois_text, or None if done."""
+    ref = whois_referral(whois_text)
+    if ref is None or split_server(ref) == split_server(server):
+        return None
+    if server == WHOIS_SERVER and "." in ip:
+        whois_referrals[ip.split(".")[0]] = ref
+    return ref
+
+def first_whois_server(ip: str) -> str:
+    if "." in ip:
+        return whois_referrals.get(ip.split(".")[0], WHOIS_SERVER)
+    return WHOIS_SERVER
+
+def whois_server_unknown(host: str, e: gaierror) -> OSError:
+    # not a gaierror any more: the domain being looked up does exist, so this
+    # must not be cached as its nxdomain
+    return OSError(f"whois server {host}: {e.strerror or e}")
+
+def whois_query(server: str, query: str) -> str:
+    """
+    Send one query to a whois server and read until it closes the connection,
+    all within WHOIS_TIMEOUT (or the request's remaining budget).
+    """
+    host, port = split_server(server)
+    with upstream_slot(upstream_name(host, port, WHOIS_PORT), WHOIS_DEFAULT_LIMIT) as call:
+        timeout = call.timeout(WHOIS_TIMEOUT)
+        end = monotonic() + timeout
+        try:
+            sock = create_connection((host, port), timeout=timeout)
+        except gaierror as e:
+            raise whois_server_unknown(host, e) from e
+        with sock:
+            sock.sendall(query.encode() + b"\r\n")
+            chunks = []
+            while True:
+                # one total timeout, so a server trickling bytes can't hold us
+                sock.settimeout(max(end - monotonic(), 0.001))
+                data = sock.recv(4096)
+                if not data:
+                    break
+                chunks.append(data)
+    return b"".join(chunks).decode("utf-8", errors="replace")
+
+@cached_stage("whois")
 def whois_lookup(ip: str) -> str:
-    """Run whois on an IP and return raw text output."""
-    status, output = getstatusoutput(f"whois {ip}")
-    # if whois fails for some reason, still return whatever we got
-    return output
+    """
+    Look an IP up over TCP/43 and return the raw text of the most specific
+    server's answer (the same text the whois binary would print for it).
+    """
+    server = first_whois_server(ip)
+    text = whois_query(server, whois_query_line(server, ip))
+    for _ in range(WHOIS_MAX_REFERRALS):
+        ref = next_whois_server(ip, server, text)
+        if ref is None:
+            break
+        server = ref
+        text = whois_query(server, whois_query_line(server, ip))
+    index_range(extract_range(text))
+    return text.rstrip("\n")
+
+# whois key (lowercased) -> WhoisRecord field it feeds
+WHOIS_FIELDS = {
+    "address": "street", "street": "street", "street address": "street", "orgaddress": "street",
+    "city": "city", "orgcity": "city",
+    "state": "state", "state/province": "state", "orgstateprov": "state",
+    "postalcode": "postal", "zipcode": "postal", "zip": "postal", "orgpostalcode": "postal",
+    "country": "country", "orgcountry": "country",
+    "netrange": "net_range", "inetnum": "net_range", "inet6num": "net_range",
+    "originas": "origin_as", "origin": "origin_as", "origin as": "origin_as",
+    "orgname": "org", "org-name": "org", "organization": "org", "owner": "org",
+}
+
+
+class WhoisRecord(NamedTuple):
+    """The fields we use from one whois response, filled by parse_whois()."""
+    street: str = None
+    city: str = None
+    state: str = None
+    postal: str = None
+    country: str = None
+    address_line: str = None  # first "...address: ..." value, the fallback address
+    net_range: str = None     # first NetRange/inetnum/inet6num
+    origin_as: str = None     # like "AS15169"
+    org: str = None
+
+    def address(self) -> str:
+        """
+        One-line physical/business address: street + "City, ST, ZIP",
+        else the first Address: line, else "Address not found".
+        """
+        parts = []
+        if self.street:
+            parts.append(self.street)
+        # If we have city/state/postal, format like "City, ST, ZIP"
+        city_state_zip = [p for p in (self.city, self.state, self.postal) if p]
+        if city_state_zip:
+            parts.append(", ".join(city_state_zip))
+        if parts:
+            return ", ".join(parts)
+        return self.address_line or "Address not found"
+
+
+def as_number(value: str):
+    """'AS15169', '15169' or 'AS15169 AS36040' -> 'AS15169', or None."""
+    for token in value.replace(",", " ").split():
+        token = token.upper()
+        if token.startswith("AS") and token[2:].isdigit():
+            return token
+        if token.isdigit():
+            return "AS" + token
+    return None
+
+@lru_cache(maxsize=256)
+def parse_whois(whois_text: str) -> WhoisRecord:
+    """
+    Single pass over raw whois text (ARIN, RIPE, APNIC, LACNIC styles).
+    Multi-line street addresses are joined with spaces; for the other
+    address fields the last value wins, for range/origin/org the first.
+    Cached per text, so /address, /range and /weather parse a shared
+    whois answer once.
+    """
+    found = {}
+    street = None
+    address_line = None
+    for l in whois_text.splitlines():
+        low = l.lower()
+        k, sep, _ = low.partition(":")
+        if not sep:
+            continue
+        if address_line is None and "address:" in low:
+            address_line = l.partition(":")[2].strip()
+        field = WHOIS_FIELDS.get(k.strip())
+        if field is None:
+            continue
+        val = l.partition(":")[2].strip()
+        if field == "street":
+            street = f"{street} {val}".strip() if street else val
+        elif field in ("city", "state", "postal", "country"):
+            found[field] = val
+        elif field not in found:
+            if field == "origin_as":
+                val = as_number(val)
+                if val is None:
+                    continue
+            found[field] = val
+    return WhoisRecord(street=street, address_line=address_line, **found)
 
 def extract_address(whois_text: str) -> str:
     """
@@ -34,71 +1504,149 @@ def extract_address(whois_text: str) -> str:
     street + city + state + postalCode
     If we can't build a nice structured one, we fallback to the first Address: line.
     """
-    lines = [l.strip() for l in whois_text.splitlines()]
+    return parse_whois(whois_text).address()
 
-    street = None
-    city = None
-    state = None
-    postal = None
+# Upstream base URLs; override to point the server at local stand-ins.
+CENSUS_GEOCODER_URL = environ.get("LAB3_CENSUS_URL", "https://geocoding.geo.census.gov/geocoder")
+CENSUS_ONELINE_URL = f"{CENSUS_GEOCODER_URL}/locations/onelineaddress"
+CENSUS_BATCH_URL = f"{CENSUS_GEOCODER_URL}/locations/addressbatch"
+WEATHER_API_URL = environ.get("LAB3_WEATHER_URL", "https://api.weather.gov")
+WEATHER_HEADERS = {"User-Agent": "CSCD330-Lab3 (student@example.edu)"}
 
-    for l in lines:
-        if ":" not in l:
-            continue
-        k, v = l.split(":", 1)
-        key = k.strip().lower()
-        val = v.strip()
+# Census and weather.gov calls share one pooled session, so repeat lookups
+# reuse a kept-alive connection instead of paying TCP+TLS setup each time.
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 10
+# max open connections per upstream host; extra callers wait for a free one
+HTTP_POOL_SIZE = int(environ.get("LAB3_HTTP_POOL_SIZE", "10"))
 
-        if key in ("address", "street", "street address", "orgaddress"):
-            street = (street + " " + val).strip() if street else val
-        elif key in ("city", "orgcity"):
-            city = val
-        elif key in ("state", "state/province", "orgstateprov"):
-            state = val
-        elif key in ("postalcode", "zipcode", "zip", "orgpostalcode"):
-            postal = val
-
-    # Best-case formatted address
-    parts = []
-    if street:
-        parts.append(street)
-    # If we have city/state/postal, format like "City, ST, ZIP"
-    city_state_zip_parts = []
-    if city:
-        city_state_zip_parts.append(city)
-    if state:
-        city_state_zip_parts.append(state)
-    if postal:
-        city_state_zip_parts.append(postal)
-
-    if city_state_zip_parts:
-        # join that sub-block with ", "
-        parts.append(", ".join(city_state_zip_parts))
-
-    if parts:
-        return ", ".join(parts)
-
-    # fallback: grab first line with 'Address:' in it
-    for l in lines:
-        low = l.lower()
-        if "address:" in low:
-            return l.split(":", 1)[1].strip()
+def make_session() -> Session:
+    """requests.Session with a bounded keep-alive pool per host."""
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-    return "Address not found"
+http = make_session()
 
-def geocode_address_one_line(address: str):
+def http_attempt(url: str, **kwargs):
     """
-    Use the Census geocoder API to get (lat, lon) for a one-line address.
-    Returns (lat, lon) as floats or (None, None) if no match.
+    One GET through the shared session with connect/read timeouts cut to the
+    request's remaining budget. 5xx answers raise (and count against the
+    host's circuit breaker).
     """
-    url = "https://geocoding.geo.census.gov/geocoder/locations/onelineaddress"
-    params = {
+    with upstream_slot(http_upstream(url)) as call:
+        timeout = call.timeout(HTTP_READ_TIMEOUT)
+        kwargs.setdefault("timeout", (min(HTTP_CONNECT_TIMEOUT, timeout), timeout))
+        resp = http.get(url, **kwargs)
+        if resp.status_code >= 500:
+            resp.raise_for_status()
+        return resp
+
+# Hedged requests (LAB3_HEDGE=1): in the geocode, points and forecast
+# stages, if a GET hasn't answered within that stage's observed p95 latency a
+# second identical GET goes out and whichever answers first is used. Hedges
+# are capped at HEDGE_MAX_RATIO extra requests per request sent (plus a
+# small burst), so during an outage they can't multiply the traffic.
+HEDGE_ENABLED = environ.get("LAB3_HEDGE", "") not in ("", "0")
+HEDGE_STAGES = ("geocode", "points", "forecast")
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20      # don't trust a p95 from fewer stage calls than this
+HEDGE_MIN_DELAY = 0.05      # seconds
+HEDGE_MAX_RATIO = float(environ.get("LAB3_HEDGE_MAX_RATIO", "0.1"))
+HEDGE_BURST = 10
+
+
+class HedgeBudget:
+    """Token bucket filled by sent requests and drained by hedges, for one stage."""
+
+    def __init__(self):
+        self.tokens = float(HEDGE_BURST)
+        self.hedged = 0   # second requests sent
+        self.won = 0      # ...that answered first
+        self.denied = 0   # hedges skipped for lack of budget
+        self._lock = Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(HEDGE_BURST, self.tokens + HEDGE_MAX_RATIO)
+
+    def spend(self) -> bool:
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.hedged += 1
+                return True
+            self.denied += 1
+            return False
+
+    def record_win(self):
+        with self._lock:
+            self.won += 1
+
+
+hedge_budgets = {stage: HedgeBudget() for stage in HEDGE_STAGES}
+# each hedged GET runs both attempts here so the caller can wait on either
+hedge_pool = ThreadPoolExecutor(max_workers=int(environ.get("LAB3_HEDGE_WORKERS", "64")))
+
+def hedge_delay(stage):
+    """Seconds to wait before hedging a GET in this stage, or None to not hedge."""
+    if not HEDGE_ENABLED or stage not in hedge_budgets:
+        return None
+    metrics = stage_metrics.get(stage)
+    if metrics is None or metrics.latency.count < HEDGE_MIN_SAMPLES:
+        return None
+    delay = max(metrics.latency.quantile(HEDGE_QUANTILE), HEDGE_MIN_DELAY)
+    # no point hedging if the budget ends before the hedge could go out
+    return delay if delay < stage_timeout(HTTP_READ_TIMEOUT) else None
+
+def close_response(future):
+    """Done-callback for a losing attempt: free its pooled connection."""
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def http_get(url: str, **kwargs):
+    """http_attempt, hedged with a second attempt when the stage allows it."""
+    stage = current_stage.get()
+    delay = hedge_delay(stage)
+    if delay is None:
+        return http_attempt(url, **kwargs)
+    budget = hedge_budgets[stage]
+    budget.deposit()
+    # each attempt runs in a copy of our context: same deadline, stage and priority
+    first = hedge_pool.submit(copy_context().run, http_attempt, url, **kwargs)
+    try:
+        return first.result(timeout=delay)
+    except FuturesTimeoutError:
+        pass
+    if not budget.spend():
+        return first.result()
+    second = hedge_pool.submit(copy_context().run, http_attempt, url, **kwargs)
+    done, _ = futures_wait((first, second), return_when=FIRST_COMPLETED)
+    winner = next((f for f in done if f.exception() is None), None)
+    if winner is None:
+        # the first answer was an error; the other attempt may still succeed
+        winner = second if first in done else first
+        futures_wait((winner,))
+    elif winner is second:
+        budget.record_win()
+    # a blocking GET can't be interrupted; the loser just finishes in the background
+    loser = second if winner is first else first
+    if not loser.cancel():
+        loser.add_done_callback(close_response)
+    return winner.result()
+
+def geocode_params(address: str) -> dict:
+    """Query parameters for a Census one-line address lookup."""
+    return {
         "address": address,
         "benchmark": "Public_AR_Current",
         "format": "json"
     }
-    resp = get(url, params=params)
-    js = loads(resp.text)
 
+def parse_geocode(js: dict):
+    """Pull (lat, lon) out of a Census geocoder response, or (None, None)."""
     matches = js.get("result", {}).get("addressMatches", [])
     if not matches:
         return None, None
@@ -109,30 +1657,200 @@ def geocode_address_one_line(address: str):
     lon = coords["x"]
     return lat, lon
 
-def get_forecast_text(lat: float, lon: float) -> str:
+def parse_forecast(js: dict) -> str:
+    """Return the first period's detailedForecast from a weather.gov forecast."""
+    periods = js["properties"]["periods"]
+    if not periods:
+        return "Forecast not found"
+
+    return periods[0].get("detailedForecast", "Forecast not found")
+
+# Geocodes are cached under a normalized address so that the same registrant
+# address from different domains (or with different spacing, case or
+# punctuation) costs one Census call. Misses are cached too, for less time.
+GEOCODE_MISS_TTL = 6 * 60 * 60
+
+ZIP_RE = re_compile(r"\b(\d{5})(?:-\d{4})?\b")
+WORD_RE = re_compile(r"[a-z0-9]+")
+
+def normalize_address(address: str):
     """
-    Use weather.gov API:
-    1. GET /points/<lat>,<lon>
-    2. Follow 'forecast' URL (NOT hourly)
-    3. Return periods[0]['detailedForecast']
+    Fold an address to a cache key: (lowercase words joined by single
+    spaces, 5-digit ZIP or ""). The last ZIP-looking number is the ZIP, so
+    a 5-digit street number earlier in the line is left alone.
     """
-    headers = {"User-Agent": "CSCD330-Lab3 (student@example.edu)"}
+    text = address.lower()
+    zips = list(ZIP_RE.finditer(text))
+    zipc = ""
+    if zips:
+        m = zips[-1]
+        zipc = m.group(1)
+        text = text[:m.start()] + " " + text[m.end():]
+    words = WORD_RE.findall(text)
+    # "..., US" / "..., USA" adds nothing for a US-only geocoder
+    while words and words[-1] in ("us", "usa"):
+        words.pop()
+    # the ZIP already pins the state, and whois sources differ on including it
+    if zipc and words and len(words[-1]) == 2 and words[-1].isalpha():
+        words.pop()
+    return " ".join(words), zipc
 
-    # Discover forecast endpoint
-    points_url = f"https://api.weather.gov/points/{lat},{lon}"
-    p = get(points_url, headers=headers)
-    p_js = loads(p.text)
+def geocode_ttl(latlon) -> float:
+    return GEOCODE_MISS_TTL if latlon[0] is None else STAGE_TTLS["geocode"]
 
-    forecast_url = p_js["properties"]["forecast"]
+@cached_stage("geocode", key=normalize_address, ttl=geocode_ttl)
+def geocode_address_one_line(address: str):
+    """
+    Use the Census geocoder API to get (lat, lon) for a one-line address.
+    Returns (lat, lon) as floats or (None, None) if no match.
+    """
+    resp = http_get(CENSUS_ONELINE_URL, params=geocode_params(address))
+    resp.raise_for_status()  # an outage is not a "no match" to cache for hours
+    return parse_geocode(loads(resp.text))
 
-    # Fetch forecast
-    f = get(forecast_url, headers=headers)
-    f_js = loads(f.text)
-    periods = f_js["properties"]["periods"]
-    if not periods:
-        return "Forecast not found"
+#########################
+# Bulk (batch) geocoding #
+#########################
 
-    return periods[0].get("detailedForecast", "Forecast not found")
+# The Census batch endpoint takes a CSV upload of up to 10,000 addresses
+# (id, street, city, state, zip) and answers with one CSV row per address.
+# Results go into the same geocode stage cache the one-line path reads.
+CENSUS_BATCH_SIZE = 10000
+CENSUS_BATCH_WORKERS = 4
+CENSUS_BATCH_TIMEOUT = 600  # seconds; a full 10k batch takes minutes
+
+def split_address(address: str):
+    """
+    Best-effort split of a one-line address ("street, city, ST, ZIP" as
+    extract_address builds it) into (street, city, state, zip).
+    """
+    zips = list(ZIP_RE.finditer(address))
+    zipc = ""
+    if zips:
+        m = zips[-1]
+        zipc = m.group(1)
+        address = address[:m.start()] + address[m.end():]
+    parts = [p.strip() for p in address.split(",") if p.strip()]
+    if parts and parts[-1].upper() in ("US", "USA"):
+        parts.pop()
+    state = ""
+    if parts and len(parts[-1]) == 2 and parts[-1].isalpha():
+        state = parts.pop()
+    city = parts.pop() if len(parts) > 1 else ""
+    return ", ".join(parts), city, state, zipc
+
+def batch_csv(addresses: list) -> str:
+    """CSV upload body; the row id is the address's index in the list."""
+    out = StringIO()
+    w = csv_writer(out)
+    for i, address in enumerate(addresses):
+        w.writerow([i, *split_address(address)])
+    return out.getvalue()
+
+def parse_batch_csv(text: str, count: int) -> dict:
+    """
+    Census batch response -> {upload index: (lat, lon)} for the Match rows.
+    Columns: id, input, Match|No_Match|Tie, exactness, matched address, "lon,lat", ...
+    """
+    results = {}
+    for row in csv_reader(StringIO(text)):
+        if len(row) < 6 or row[2] != "Match" or not row[0].isdigit():
+            continue
+        i = int(row[0])
+        lon, _, lat = row[5].partition(",")
+        try:
+            if i < count:
+                results[i] = (float(lat), float(lon))
+        except ValueError:
+            continue
+    return results
+
+def geocode_chunk(addresses: list) -> int:
+    """
+    Upload one chunk to the batch endpoint and cache its matches. Returns
+    how many matched. No_Match and Tie rows, and rows missing from the
+    answer, aren't cached: the batch geocoder only sees split_address's
+    guess at the fields, and the one-line lookup (which takes the first of
+    tied matches) often succeeds where it didn't.
+    """
+    # bulk uploads queue behind live lookups and may wait as long as one takes
+    with track("geocode_batch"), background_priority(), upstream_slot(http_upstream(CENSUS_BATCH_URL), timeout=CENSUS_BATCH_TIMEOUT):
+        resp = http.post(
+            CENSUS_BATCH_URL,
+            data={"benchmark": "Public_AR_Current"},
+            files={"addressFile": ("addresses.csv", batch_csv(addresses), "text/csv")},
+            timeout=(HTTP_CONNECT_TIMEOUT, CENSUS_BATCH_TIMEOUT),
+        )
+        resp.raise_for_status()
+    geocode_cache = stage_caches["geocode"]
+    matches = parse_batch_csv(resp.text, len(addresses))
+    for i, latlon in matches.items():
+        geocode_cache.set(normalize_address(addresses[i]), latlon, geocode_ttl(latlon))
+    return len(matches)
+
+def batch_geocode(addresses) -> dict:
+    """
+    Pre-populate the geocode cache for many addresses at once: skips
+    addresses already cached (after normalization), uploads the rest in
+    CENSUS_BATCH_SIZE chunks on CENSUS_BATCH_WORKERS threads.
+    """
+    geocode_cache = stage_caches["geocode"]
+    todo = {}
+    for address in addresses:
+        key = normalize_address(address)
+        if key not in todo and geocode_cache.get(key, _MISSING) is _MISSING:
+            todo[key] = address
+    pending = list(todo.values())
+    chunks = [pending[i:i + CENSUS_BATCH_SIZE] for i in range(0, len(pending), CENSUS_BATCH_SIZE)]
+
+    summary = {"submitted": len(pending), "matched": 0, "failed_chunks": 0}
+    with ThreadPoolExecutor(max_workers=CENSUS_BATCH_WORKERS) as pool:
+        for fut in as_completed([pool.submit(geocode_chunk, c) for c in chunks]):
+            try:
+                summary["matched"] += fut.result()
+            except Exception as e:
+                summary["failed_chunks"] += 1
+                app.logger.warning("batch geocode chunk failed: %s", e)
+    return summary
+
+# weather.gov forecasts are per 2.5 km NWS grid cell, and a point's cell
+# almost never changes. /points answers are cached for a month under the
+# coordinate rounded to POINTS_PRECISION decimals (~1.1 km), and forecasts
+# are cached per (office, gridX, gridY), so every address in a cell shares one.
+POINTS_PRECISION = 2
+
+def quantize_point(lat: float, lon: float):
+    return round(float(lat), POINTS_PRECISION), round(float(lon), POINTS_PRECISION)
+
+def parse_points(js: dict):
+    """/points response -> grid cell (office, gridX, gridY, forecast_url, hourly_url)."""
+    props = js["properties"]
+    return props["gridId"], props["gridX"], props["gridY"], props["forecast"], props["forecastHourly"]
+
+def grid_key(cell) -> tuple:
+    return cell[:3]
+
+@cached_stage("points", key=quantize_point)
+def lookup_grid(lat: float, lon: float):
+    """GET /points/<lat>,<lon> (quantized) and return the NWS grid cell."""
+    lat, lon = quantize_point(lat, lon)
+    p = http_get(f"{WEATHER_API_URL}/points/{lat},{lon}", headers=WEATHER_HEADERS)
+    return parse_points(loads(p.text))
+
+@cached_stage("forecast", key=grid_key)
+def grid_forecast(cell) -> str:
+    """Fetch the (non-hourly) forecast for a grid cell, cached per cell."""
+    f = http_get(cell[3], headers=WEATHER_HEADERS)
+    return parse_forecast(loads(f.text))
+
+def get_forecast_text(lat: float, lon: float) -> str:
+    """
+    Use weather.gov API:
+    1. GET /points/<lat>,<lon> -> grid cell (cached per ~1 km)
+    2. Follow 'forecast' URL (NOT hourly), cached per grid cell
+    3. Return periods[0]['detailedForecast']
+    """
+    return grid_forecast(lookup_grid(lat, lon))
 
 def extract_range(whois_text: str):
     """
@@ -141,19 +1859,469 @@ def extract_range(whois_text: str):
     Example: NetRange:       142.250.0.0 - 142.251.255.255
     We'll also try 'inetnum:' (RIPE/APNIC style)
     """
-    lines = whois_text.splitlines()
-    for l in lines:
-        if ":" not in l:
-            continue
-        k, v = l.split(":", 1)
-        key = k.strip().lower()
-        val = v.strip()
-        if key == "netrange":
-            return val  # already "start - end"
-        if key == "inetnum":
-            return val  # often "start - end"
+    return parse_whois(whois_text).net_range or "Range not found"
+
+#################
+# IP range index #
+#################
+
+RANGE_MERGE_BATCH = 512  # live adds buffered before they are merged into the main index
+
+
+def flatten_ranges(starts, ends):
+    """
+    Ranges sorted by (start, widest first) -> non-overlapping segments
+    (seg_starts, seg_ends, owners). Each segment is owned by the index of the
+    range covering it that starts last (the narrowest, for nested ranges).
+    """
+    seg_starts, seg_ends, owners = [], [], []
+    stack = []  # ranges open at pos, latest start on top
+    pos = 0
+    for i in range(len(starts) + 1):
+        limit = starts[i] if i < len(starts) else None
+        # hand out [pos, limit) to the open ranges, innermost first
+        while stack and (limit is None or pos < limit):
+            top = stack[-1]
+            if ends[top] < pos:
+                stack.pop()  # ended inside a later range
+                continue
+            end = ends[top] if limit is None else min(ends[top], limit - 1)
+            seg_starts.append(pos)
+            seg_ends.append(end)
+            owners.append(top)
+            pos = end + 1
+            if end == ends[top]:
+                stack.pop()
+        if limit is not None:
+            stack.append(i)
+            pos = limit
+    return seg_starts, seg_ends, owners
+
+
+class RangeIndex:
+    """
+    Interval index over integer IPs for whois network ranges of one address
+    family, so an IP inside any range we have already seen is answered from
+    memory instead of by another whois query.
+
+    Ranges live in parallel arrays sorted by (start, widest first), and are
+    flattened into non-overlapping segments, each owned by the most specific
+    range covering it, so a lookup is a single bisect. Bulk loads (add_many)
+    sort and flatten once. Single adds from live lookups go into a small
+    sorted buffer that find() also scans; once RANGE_MERGE_BATCH of them
+    build up they are merged in by a background thread, so no request waits
+    on a re-sort. IPv4 bounds are packed into array("Q") (8 bytes each)
+    rather than int objects.
+    """
+
+    def __init__(self, version: int):
+        self.version = version
+        # replaced whole by _install, never changed in place
+        self._starts = []
+        self._ends = []
+        self._labels = []  # original whois text, or None when it is "start - end"
+        self._seg_starts = []
+        self._seg_ends = []
+        self._owners = []  # segment -> index into _starts/_ends/_labels
+        self._recent = []  # sorted (start, -end, end, label) not merged yet
+        self._merging = []  # the batch of _recent a background merge is folding in
+        self._lock = Lock()
+        self._merge_lock = Lock()  # one rebuild at a time
+
+    def add(self, start: int, end: int, label: str = None):
+        entry = (start, -end, end, label)
+        with self._lock:
+            i = bisect_left(self._recent, entry[:3])
+            if i < len(self._recent) and self._recent[i][:3] == entry[:3]:
+                return
+            self._recent.insert(i, entry)
+            if len(self._recent) >= RANGE_MERGE_BATCH and not self._merging:
+                self._merging, self._recent = self._recent, []
+                Thread(target=self._merge_batch, daemon=True).start()
+
+    def add_many(self, entries):
+        """Add an iterable of (start, end, label) with one sort; for bulk loads."""
+        batch = sorted(((start, -end, end, label) for start, end, label in entries), key=lambda e: e[:2])
+        self._rebuild(batch)
+
+    def _merge_batch(self):
+        self._rebuild(self._merging)
+        with self._lock:
+            self._merging = []
+
+    def _rebuild(self, batch: list):
+        """Merge a sorted batch of (start, -end, end, label) into the main arrays."""
+        with self._merge_lock:
+            current = zip(self._starts, (-e for e in self._ends), self._ends, self._labels)
+            starts, ends, labels = [], [], []
+            last = None
+            for start, _, end, label in heap_merge(current, batch, key=lambda e: e[:2]):
+                if (start, end) == last:
+                    continue
+                last = (start, end)
+                starts.append(start)
+                ends.append(end)
+                labels.append(label)
+            seg_starts, seg_ends, owners = flatten_ranges(starts, ends)
+            if self.version == 4:
+                starts, ends = array("Q", starts), array("Q", ends)
+                seg_starts, seg_ends, owners = array("Q", seg_starts), array("Q", seg_ends), array("Q", owners)
+            with self._lock:
+                self._starts, self._ends, self._labels = starts, ends, labels
+                self._seg_starts, self._seg_ends, self._owners = seg_starts, seg_ends, owners
+
+    def find(self, n: int):
+        """Return the most specific (start, end, label) containing n, or None."""
+        best = None
+        with self._lock:
+            i = bisect_right(self._seg_starts, n) - 1
+            if i >= 0 and self._seg_ends[i] >= n:
+                owner = self._owners[i]
+                best = self._starts[owner], self._ends[owner], self._labels[owner]
+            for buffer in (self._merging, self._recent):
+                # latest start first; for equal starts the narrowest first
+                for j in range(bisect_left(buffer, (n + 1,)) - 1, -1, -1):
+                    start, _, end, label = buffer[j]
+                    if end >= n:
+                        if best is None or (start, -end) > (best[0], -best[1]):
+                            best = start, end, label
+                        break
+        return best
+
+    def __len__(self):
+        with self._lock:
+            return len(self._starts) + len(self._merging) + len(self._recent)
+
+
+# one index per address family
+range_indexes = {4: RangeIndex(4), 6: RangeIndex(6)}
+
+def parse_range(range_text: str):
+    """'a - b' or CIDR -> (version, start_int, end_int), or None."""
+    try:
+        if "-" in range_text:
+            a, b = range_text.split("-", 1)
+            first, last = ip_address(a.strip()), ip_address(b.strip())
+        else:
+            net = ip_network(range_text.strip(), strict=False)
+            first, last = net.network_address, net.broadcast_address
+    except ValueError:
+        return None
+    if first.version != last.version or first > last:
+        return None
+    return first.version, int(first), int(last)
 
-    return "Range not found"
+def range_entry(range_text: str):
+    """whois range text -> (version, start, end, label), or None if it can't be parsed."""
+    parsed = parse_range(range_text)
+    if parsed is None:
+        return None
+    version, start, end = parsed
+    label = None if range_text == format_range(version, start, end) else range_text
+    return version, start, end, label
+
+def index_range(range_text: str) -> bool:
+    """Add a whois range to the index. Returns False if it can't be parsed."""
+    entry = range_entry(range_text)
+    if entry is None:
+        return False
+    version, start, end, label = entry
+    range_indexes[version].add(start, end, label)
+    return True
+
+def format_range(version: int, start: int, end: int) -> str:
+    """Integer bounds -> "start - end" as whois prints NetRange."""
+    cls = IPv4Address if version == 4 else IPv6Address
+    return f"{cls(start)} - {cls(end)}"
+
+def find_range(ip: str):
+    """Most specific indexed range text containing ip, or None."""
+    addr = ip_address(ip)
+    hit = range_indexes[addr.version].find(int(addr))
+    if hit is None:
+        return None
+    start, end, label = hit
+    return label if label is not None else format_range(addr.version, start, end)
+
+def load_whois_ranges(path: str) -> int:
+    """
+    Bulk-load every NetRange/inetnum/inet6num line from saved whois output.
+    path may be a single file or a directory of files. Returns ranges added.
+    """
+    files = [join(path, f) for f in sorted(listdir(path))] if isdir(path) else [path]
+    entries = {4: [], 6: []}
+    for name in files:
+        with open(name, encoding="utf-8", errors="replace") as fh:
+            for l in fh:
+                if ":" not in l:
+                    continue
+                k, v = l.split(":", 1)
+                if k.strip().lower() in ("netrange", "inetnum", "inet6num"):
+                    entry = range_entry(v.strip())
+                    if entry is not None:
+                        entries[entry[0]].append(entry[1:])
+    for version, batch in entries.items():
+        if batch:
+            range_indexes[version].add_many(batch)
+    return sum(len(batch) for batch in entries.values())
+
+# Saved whois output to preload, as paths separated by os.pathsep
+for _path in filter(None, environ.get("LAB3_RANGE_FILES", "").split(pathsep)):
+    load_whois_ranges(_path)
+
+def domain_whois(domain: str) -> str:
+    """domain -> ip -> whois text, both hops served from the stage caches."""
+    return whois_lookup(resolve_ip(domain))
+
+def require_address(whois_text: str, message: str = "Address not found") -> str:
+    addr = extract_address(whois_text)
+    if addr == "Address not found":
+        raise NoResult("no_address", message)
+    return addr
+
+def require_range(rng: str) -> str:
+    if rng == "Range not found":
+        raise NoResult("no_range", rng)
+    return rng
+
+def require_latlon(latlon):
+    if latlon[0] is None or latlon[1] is None:
+        raise NoResult("geocode_miss", "Forecast not found (address could not be geocoded)")
+    return latlon
+
+def compute_address(domain: str) -> str:
+    # whois text is shared with /weather and /range
+    return require_address(domain_whois(domain))
+
+def compute_weather(domain: str) -> str:
+    # domain -> ip -> whois -> address
+    addr = require_address(domain_whois(domain), "Forecast not found (no address in whois)")
+
+    # address -> lat/lon
+    lat, lon = require_latlon(geocode_address_one_line(addr))
+    # lat/lon -> forecast text
+    return get_forecast_text(lat, lon)
+
+def compute_range(domain: str) -> str:
+    ip = resolve_ip(domain)
+    # any IP inside an already-seen range skips whois entirely
+    rng = find_range(ip)
+    if rng is None:
+        rng = require_range(extract_range(whois_lookup(ip)))
+
+    # match assignment's output style exactly:
+    # "Network range for google.com is 142.250.0.0 - 142.251.255.255"
+    return f"Network range for {domain} is {rng}"
+
+# route name -> function computing that route's response for a domain
+ROUTE_COMPUTE = {
+    "address": compute_address,
+    "weather": compute_weather,
+    "range": compute_range,
+}
+
+def stored_result(key):
+    """Look a (route, domain) key up in the on-disk store, refilling memory on a hit."""
+    store = result_store()
+    if store is None:
+        return None
+    row = store.get(*key)
+    if row is None:
+        return None
+    value, ttl = row
+    cache.set(key, value, ttl)
+    return value, ttl
+
+def save_result(key, value: str):
+    """Write a freshly computed route result through to the on-disk store."""
+    store = result_store()
+    if store is not None:
+        store.set(key[0], key[1], value, route_storage_ttl(key[0]))
+
+# background revalidation of stale entries
+refresh_pool = ThreadPoolExecutor(max_workers=4)
+refreshing = set()
+refreshing_lock = Lock()
+
+def refresh_in_background(route: str, domain: str):
+    """Recompute a stale (route, domain) result off the request path, once."""
+    key = (route, domain)
+    with refreshing_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+
+    def refresh():
+        try:
+            with background_priority():
+                value = ROUTE_COMPUTE[route](domain)
+            cache.set(key, value, route_storage_ttl(route))
+            save_result(key, value)
+        except Exception as e:
+            # keep serving the stale copy until it hits its max age
+            app.logger.warning("refresh of %s failed: %s", key, e)
+        finally:
+            with refreshing_lock:
+                refreshing.discard(key)
+
+    refresh_pool.submit(refresh)
+
+def cached_route_result(route: str, domain: str):
+    """
+    Memory cache, then on-disk store. Returns (value, ttl_left) or None, and
+    kicks off a background refresh if the value is past its fresh window.
+    """
+    key = (route, domain)
+    return revalidate(route, domain, cache.get_with_ttl(key) or stored_result(key))
+
+async def cached_route_result_async(route: str, domain: str):
+    """cached_route_result, with the on-disk store read run off the event loop."""
+    key = (route, domain)
+    hit = cache.get_with_ttl(key)
+    if hit is None and STORE_PATH:
+        hit = await get_running_loop().run_in_executor(None, stored_result, key)
+    return revalidate(route, domain, hit)
+
+def revalidate(route: str, domain: str, hit):
+    """Pass a cache hit through, refreshing it in the background if it is stale."""
+    if hit is not None and is_stale(route, hit[1]):
+        refresh_in_background(route, domain)
+    return hit
+
+
+def classify_failure(domain: str, e: Exception) -> Failure:
+    if isinstance(e, NoResult):
+        return Failure(e.kind, str(e))
+    if isinstance(e, gaierror) and e.errno == EAI_NONAME:
+        return Failure("nxdomain", f"Domain not found: {domain}")
+    if isinstance(e, DeadlineExceeded) or deadline_expired():
+        # whatever broke, the budget running out is why we stopped
+        return Failure("deadline", f"Lookup timed out: {e}")
+    if isinstance(e, CircuitOpen):
+        return Failure("circuit_open", f"Upstream unavailable: {e}")
+    return Failure("upstream_error", f"Lookup failed: {type(e).__name__}: {e}")
+
+def failure_key(route: str, domain: str, kind: str) -> tuple:
+    return ("resolve", domain) if kind == "nxdomain" else (route, domain)
+
+def cached_failure(route: str, domain: str):
+    """Raise LookupFailed if this route, or the domain's DNS, failed recently."""
+    hit = failed_lookups.get_with_ttl((route, domain)) or failed_lookups.get_with_ttl(("resolve", domain))
+    if hit is not None:
+        raise LookupFailed(*hit)
+
+def remember_failure(route: str, domain: str, e: Exception) -> LookupFailed:
+    """
+    Cache the typed failure behind e and return the LookupFailed to raise.
+    Every waiter of a coalesced lookup gets here with the same failure; only
+    the first records and counts it, the rest share its entry.
+    """
+    failure = classify_failure(domain, e)
+    key = failure_key(route, domain, failure.kind)
+    hit = failed_lookups.get_with_ttl(key)
+    if hit is not None and hit[0].kind == failure.kind:
+        return LookupFailed(*hit)
+    ttl = FAILURE_TTLS[failure.kind]
+    failed_lookups.set(key, failure, ttl)
+    negative_results[failure.kind] += 1
+    if failure.kind == "upstream_error":
+        app.logger.warning("%s %s failed: %s", route, domain, failure.message)
+    return LookupFailed(failure, ttl)
+
+def failure_response(e: LookupFailed):
+    """(status, body, headers) for a failure; clients may cache it as long as we do."""
+    headers = {"Cache-Control": f"public, max-age={int(e.ttl_left)}"}
+    return FAILURE_STATUS[e.failure.kind], e.failure.message, headers
+
+
+class RouteResult(NamedTuple):
+    value: str
+    from_cache: bool
+    ttl_left: float  # seconds until the entry's hard max age
+
+
+def lookup(route: str, domain: str) -> RouteResult:
+    """
+    Return the result for a route and domain, computing it on a miss.
+    Concurrent requests for the same cold (route, domain) wait on one
+    computation instead of each starting their own upstream lookups.
+    """
+    cached = cached_route_result(route, domain)
+    if cached is not None:
+        return RouteResult(cached[0], True, cached[1])
+
+    key = (route, domain)
+    cached_failure(route, domain)
+    compute = ROUTE_COMPUTE[route]
+
+    def compute_and_store():
+        value = compute(domain)
+        save_result(key, value)
+        return value
+
+    ttl = route_storage_ttl(route)
+    try:
+        return RouteResult(cache.get_or_compute(key, compute_and_store, ttl), False, ttl)
+    except Exception as e:
+        raise remember_failure(route, domain, e) from e
+
+# HTTP caching: every route answer carries validators and a max-age taken
+# from its cache entry, so clients and CDNs can reuse it and revalidate with
+# a conditional GET that costs no upstream work.
+not_modified_responses = 0
+
+def route_etag(value: str) -> str:
+    # weak: the body differs by the "Cached: " prefix, the result doesn't
+    return 'W/"%s"' % blake2b(value.encode(), digest_size=8).hexdigest()
+
+def cache_headers(route: str, result: RouteResult) -> dict:
+    """Cache-Control, ETag and Last-Modified derived from the entry's TTL."""
+    age = max(0.0, route_storage_ttl(route) - result.ttl_left)
+    fresh = max(0, int(ROUTE_TTLS[route] - age))
+    cache_control = f"public, max-age={fresh}"
+    if route_storage_ttl(route) > ROUTE_TTLS[route]:
+        # we serve stale copies ourselves until the max age; let caches do the same
+        cache_control += f", stale-while-revalidate={int(result.ttl_left) - fresh}"
+    return {
+        "Cache-Control": cache_control,
+        "ETag": route_etag(result.value),
+        "Last-Modified": formatdate(int(time() - age), usegmt=True),
+    }
+
+def not_modified(headers: dict, if_none_match, if_modified_since) -> bool:
+    """Evaluate If-None-Match (which wins when present) or If-Modified-Since."""
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or headers["ETag"].removeprefix("W/") in tags
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return parsedate_to_datetime(headers["Last-Modified"]).timestamp() <= since
+    return False
+
+def route_response(route: str, result: RouteResult, if_none_match=None, if_modified_since=None):
+    """(status, body, headers) for a route result: 304 with no body if the client's copy is current."""
+    global not_modified_responses
+    headers = cache_headers(route, result)
+    if not_modified(headers, if_none_match, if_modified_since):
+        not_modified_responses += 1
+        return 304, "", headers
+    body = "Cached: " + result.value if result.from_cache else result.value
+    return 200, body, headers
+
+def serve_cached(route: str, domain: str):
+    """Answer a route from the cache ("Cached: " prefix) or compute it."""
+    start = perf_counter()
+    try:
+        with deadline_scope(route):
+            result = lookup(route, domain)
+    finally:
+        observe_route(route, perf_counter() - start)
+    status, body, headers = route_response(route, result, request.headers.get("If-None-Match"),
+                                           request.headers.get("If-Modified-Since"))
+    return body, status, headers
 
 #####################
 # Flask Endpoints   #
@@ -161,64 +2329,656 @@ def extract_range(whois_text: str):
 
 @app.route("/address/<domain>")
 def address_route(domain):
-    # check cache first
-    key = ("address", domain)
-    if key in cache:
-        return "Cached: " + cache[key]
-
-    # compute fresh
-    ip = resolve_ip(domain)
-    wtxt = whois_lookup(ip)
-    addr = extract_address(wtxt)
-
-    cache[key] = addr
-    return addr
+    return serve_cached("address", domain)
 
 @app.route("/weather/<domain>")
 def weather_route(domain):
-    # check cache first
-    key = ("weather", domain)
-    if key in cache:
-        return "Cached: " + cache[key]
+    return serve_cached("weather", domain)
 
-    # domain -> ip -> whois -> address
-    ip = resolve_ip(domain)
-    wtxt = whois_lookup(ip)
-    addr = extract_address(wtxt)
+@app.route("/range/<domain>")
+def range_route(domain):
+    return serve_cached("range", domain)
 
-    # address -> lat/lon
-    lat, lon = geocode_address_one_line(addr)
-    if lat is None or lon is None:
-        forecast_text = "Forecast not found"
+# Upper bounds for POST /batch
+BATCH_MAX_DOMAINS = 10000
+BATCH_WORKERS = int(environ.get("LAB3_BATCH_WORKERS", "32"))
+
+# shared by every batch so concurrent batches can't multiply upstream load
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+def batch_record(domain: str, fields: list) -> dict:
+    """All requested fields for one domain; failures are reported per field."""
+    record = {"domain": domain}
+    for field in fields:
+        try:
+            with deadline_scope(field):
+                record[field] = lookup(field, domain).value
+        except Exception as e:
+            record.setdefault("errors", {})[field] = str(e) or type(e).__name__
+    return record
+
+def batch_params(body):
+    """
+    Validate a POST /batch JSON body. Returns (domains, fields), or raises
+    ValueError with the message for a 400.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("domains"), list):
+        raise ValueError("Expected JSON body with a \"domains\" list")
+
+    domains = [d for d in body["domains"] if isinstance(d, str) and d]
+    fields = body.get("fields") or list(ROUTE_COMPUTE)
+    if len(domains) > BATCH_MAX_DOMAINS:
+        raise ValueError(f"At most {BATCH_MAX_DOMAINS} domains per batch")
+    if not isinstance(fields, list) or any(not isinstance(f, str) or f not in ROUTE_COMPUTE for f in fields):
+        raise ValueError("fields must be a list of: " + ", ".join(ROUTE_COMPUTE))
+
+    # dedupe while keeping order
+    return list(dict.fromkeys(domains)), fields
+
+@app.route("/batch", methods=["POST"])
+def batch_route():
+    """
+    Body: {"domains": ["google.com", ...], "fields": ["address", "range", "weather"]}
+    Streams one JSON object per domain (NDJSON) in completion order,
+    so fast domains are not held back by slow ones.
+    """
+    try:
+        domains, fields = batch_params(request.get_json(silent=True))
+    except ValueError as e:
+        return str(e), 400
+
+    def stream():
+        futures = [batch_pool.submit(batch_record, d, fields) for d in domains]
+        try:
+            for fut in as_completed(futures):
+                yield dumps(fut.result()) + "\n"
+        finally:
+            # client went away: don't run lookups nobody will read
+            for fut in futures:
+                fut.cancel()
+
+    return Response(stream(), mimetype="application/x-ndjson")
+
+@app.route("/geocode/batch", methods=["POST"])
+def geocode_batch_route():
+    """
+    Body: {"addresses": ["1600 Amphitheatre Parkway, Mountain View, CA, 94043", ...]}
+    or one address per line. Geocoding runs in the background, answer is 202.
+    """
+    return start_batch_geocode(request.get_json(silent=True), request.get_data(as_text=True))
+
+def start_batch_geocode(body, text: str):
+    """
+    Shared by both servers: take the addresses from a parsed JSON body, or
+    from the raw text one per line, and geocode them on a background thread.
+    Returns (response body, status).
+    """
+    if isinstance(body, dict) and isinstance(body.get("addresses"), list):
+        addresses = [a for a in body["addresses"] if isinstance(a, str) and a.strip()]
     else:
-        # lat/lon -> forecast text
-        forecast_text = get_forecast_text(lat, lon)
+        addresses = [l.strip() for l in text.splitlines() if l.strip()]
+    if not addresses:
+        return "Expected a JSON \"addresses\" list or one address per line", 400
 
-    cache[key] = forecast_text
-    return forecast_text
+    def run():
+        summary = batch_geocode(addresses)
+        app.logger.info("batch geocode finished: %s", summary)
 
-@app.route("/range/<domain>")
-def range_route(domain):
-    # check cache first
-    key = ("range", domain)
-    if key in cache:
-        return "Cached: " + cache[key]
+    Thread(target=run, daemon=True).start()
+    return f"Accepted {len(addresses)} addresses for batch geocoding", 202
 
-    ip = resolve_ip(domain)
-    wtxt = whois_lookup(ip)
-    rng = extract_range(wtxt)
+##########################
+# Startup cache warm-up  #
+##########################
 
-    # match assignment's output style exactly:
-    # "Network range for google.com is 142.250.0.0 - 142.251.255.255"
-    msg = f"Network range for {domain} is {rng}"
+# A domain list (one per line, "#" comments allowed) given with --warm FILE
+# or LAB3_WARM_FILE is looked up for every route in the background right
+# after startup, WARM_WORKERS at a time, while the server takes traffic.
+WARM_WORKERS = int(environ.get("LAB3_WARM_WORKERS", "8"))
+
+
+class WarmupProgress:
+    """Counters for the background warm-up, shown at /warmup and /metrics."""
+
+    def __init__(self):
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+        self._lock = Lock()
 
-    cache[key] = msg
-    return msg
+    def record(self, ok: bool):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            now = self.finished_at or time()
+            return {
+                "total": self.total,
+                "done": self.done,
+                "failed": self.failed,
+                "running": self.started_at is not None and self.finished_at is None,
+                "elapsed": round(now - self.started_at, 1) if self.started_at else 0.0,
+            }
+
+
+warmup = WarmupProgress()
+
+def read_domain_list(path: str) -> list:
+    with open(path) as fh:
+        domains = [l.split("#", 1)[0].strip() for l in fh]
+    return list(dict.fromkeys(d for d in domains if d))
+
+def warm_one(route: str, domain: str):
+    """Fill one (route, domain) entry; lookup() caches any failure as a negative entry."""
+    try:
+        with background_priority():
+            lookup(route, domain)
+        warmup.record(True)
+    except LookupFailed as e:
+        warmup.record(False)
+        app.logger.info("warm-up of %s %s failed: %s", route, domain, e)
+    except Exception:
+        # not a lookup failure but a bug; still count it so warm-up can finish
+        warmup.record(False)
+        app.logger.exception("warm-up of %s %s crashed", route, domain)
+
+def warm_domains(domains: list):
+    """Look up every route for every domain on a bounded pool, then stop."""
+    warmup.total = len(domains) * len(ROUTE_COMPUTE)
+    warmup.started_at = time()
+    with ThreadPoolExecutor(max_workers=WARM_WORKERS) as pool:
+        for domain in domains:
+            for route in ROUTE_COMPUTE:
+                pool.submit(warm_one, route, domain)
+    warmup.finished_at = time()
+    app.logger.info("warm-up finished: %s", warmup.report())
+
+def start_warmup(path: str):
+    """Kick off warm_domains for the domain list at path in a daemon thread."""
+    domains = read_domain_list(path)
+    Thread(target=warm_domains, args=(domains,), daemon=True).start()
+
+@app.route("/warmup")
+def warmup_route():
+    return "\n".join(f"{k}: {v}" for k, v in warmup.report().items()) + "\n"
+
+@app.errorhandler(LookupFailed)
+def lookup_failed(e):
+    status, body, headers = failure_response(e)
+    return body, status, headers
+
+@app.route("/cache/stats")
+def cache_stats_route():
+    # plain-text "name: value" lines, one counter per line
+    lines = [f"{k}: {v}" for k, v in cache.stats().items()]
+    for name, stage_cache in stage_caches.items():
+        lines += [f"{name}_{k}: {v}" for k, v in stage_cache.stats().items()]
+    return "\n".join(lines) + "\n"
+
+# Prometheus text exposition format; scrapers reject other content types
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4"
+PLAIN_TEXT = {"Content-Type": "text/plain; charset=utf-8"}
+
+def render_metrics() -> str:
+    """All counters and histograms in Prometheus text exposition format."""
+    lines = [
+        "# HELP lab3_stage_seconds Time spent in each upstream pipeline stage.",
+        "# TYPE lab3_stage_seconds histogram",
+    ]
+    for stage, m in sorted(stage_metrics.items()):
+        lines += m.latency.render("lab3_stage_seconds", f'stage="{stage}"')
+    lines += ["# HELP lab3_stage_inflight Upstream calls currently running.",
+              "# TYPE lab3_stage_inflight gauge"]
+    lines += [f'lab3_stage_inflight{{stage="{stage}"}} {m.inflight}'
+              for stage, m in sorted(stage_metrics.items())]
+    lines += ["# HELP lab3_upstream_errors_total Upstream calls that raised.",
+              "# TYPE lab3_upstream_errors_total counter"]
+    lines += [f'lab3_upstream_errors_total{{stage="{stage}"}} {m.errors}'
+              for stage, m in sorted(stage_metrics.items())]
+
+    lines += ["# HELP lab3_dns_fallbacks_total Lookups answered by getaddrinfo instead of our resolver.",
+              "# TYPE lab3_dns_fallbacks_total counter",
+              f"lab3_dns_fallbacks_total {dns_fallbacks}"]
+
+    lines += ["# HELP lab3_upstream_queue_depth Upstream calls waiting for a slot, per host.",
+              "# TYPE lab3_upstream_queue_depth gauge"]
+    schedulers = sorted(upstream_schedulers.items())
+    lines += [f'lab3_upstream_queue_depth{{host="{host}"}} {s.waiting}' for host, s in schedulers]
+    lines += ["# HELP lab3_upstream_active Upstream calls holding a slot, per host.",
+              "# TYPE lab3_upstream_active gauge"]
+    lines += [f'lab3_upstream_active{{host="{host}"}} {s.active}' for host, s in schedulers]
+    lines += ["# HELP lab3_upstream_queue_timeouts_total Calls that gave up waiting for a slot.",
+              "# TYPE lab3_upstream_queue_timeouts_total counter"]
+    lines += [f'lab3_upstream_queue_timeouts_total{{host="{host}"}} {s.timeouts}' for host, s in schedulers]
+    lines += ["# HELP lab3_upstream_circuit_open 1 while the host's circuit breaker is open.",
+              "# TYPE lab3_upstream_circuit_open gauge"]
+    lines += [f'lab3_upstream_circuit_open{{host="{host}"}} {int(s.breaker.is_open)}' for host, s in schedulers]
+    lines += ["# HELP lab3_upstream_circuit_trips_total Times the host's circuit opened.",
+              "# TYPE lab3_upstream_circuit_trips_total counter"]
+    lines += [f'lab3_upstream_circuit_trips_total{{host="{host}"}} {s.breaker.trips}' for host, s in schedulers]
+    lines += ["# HELP lab3_upstream_circuit_rejected_total Calls failed fast by an open circuit.",
+              "# TYPE lab3_upstream_circuit_rejected_total counter"]
+    lines += [f'lab3_upstream_circuit_rejected_total{{host="{host}"}} {s.breaker.rejected}' for host, s in schedulers]
+    lines += ["# HELP lab3_upstream_wait_seconds Time spent queued for an upstream slot.",
+              "# TYPE lab3_upstream_wait_seconds histogram"]
+    for host, s in schedulers:
+        for priority, hist in s.wait.items():
+            lines += hist.render("lab3_upstream_wait_seconds",
+                                 f'host="{host}",priority="{PRIORITY_NAMES[priority]}"')
+
+    lines += ["# HELP lab3_hedged_requests_total Second requests sent because the first was slower than p95.",
+              "# TYPE lab3_hedged_requests_total counter"]
+    lines += [f'lab3_hedged_requests_total{{stage="{stage}"}} {b.hedged}' for stage, b in hedge_budgets.items()]
+    lines += ["# HELP lab3_hedge_wins_total Hedged requests that answered before the original.",
+              "# TYPE lab3_hedge_wins_total counter"]
+    lines += [f'lab3_hedge_wins_total{{stage="{stage}"}} {b.won}' for stage, b in hedge_budgets.items()]
+    lines += ["# HELP lab3_hedges_denied_total Hedges skipped because the extra-load budget was spent.",
+              "# TYPE lab3_hedges_denied_total counter"]
+    lines += [f'lab3_hedges_denied_total{{stage="{stage}"}} {b.denied}' for stage, b in hedge_budgets.items()]
+
+    lines += ["# HELP lab3_not_modified_total Conditional GETs answered with 304 Not Modified.",
+              "# TYPE lab3_not_modified_total counter",
+              f"lab3_not_modified_total {not_modified_responses}"]
+
+    lines += ["# HELP lab3_request_seconds End-to-end latency per route.",
+              "# TYPE lab3_request_seconds histogram"]
+    for route, hist in sorted(route_latency.items()):
+        lines += hist.render("lab3_request_seconds", f'route="{route}"')
+
+    lines += ["# HELP lab3_negative_results_total Failed lookups cached, by failure kind.",
+              "# TYPE lab3_negative_results_total counter"]
+    lines += [f'lab3_negative_results_total{{kind="{kind}"}} {negative_results[kind]}'
+              for kind in FAILURE_TTLS]
+
+    progress = warmup.report()
+    lines += ["# HELP lab3_warmup_lookups Startup warm-up progress.",
+              "# TYPE lab3_warmup_lookups gauge"]
+    lines += [f'lab3_warmup_lookups{{state="{k}"}} {progress[k]}' for k in ("total", "done", "failed")]
+
+    caches = [("route", cache), ("negative", failed_lookups)] + sorted(stage_caches.items())
+    stats = [(name, c.stats()) for name, c in caches]
+    for metric, field, kind in (
+        ("lab3_cache_hits_total", "hits", "counter"),
+        ("lab3_cache_misses_total", "misses", "counter"),
+        ("lab3_cache_evictions_total", "evictions", "counter"),
+        ("lab3_cache_coalesced_total", "coalesced", "counter"),
+        ("lab3_cache_entries", "size", "gauge"),
+        ("lab3_cache_hit_ratio", "hit_ratio", "gauge"),
+    ):
+        lines.append(f"# TYPE {metric} {kind}")
+        lines += [f'{metric}{{cache="{name}"}} {st[field]}' for name, st in stats]
+    return "\n".join(lines) + "\n"
+
+@app.route("/metrics")
+def metrics_route():
+    return Response(render_metrics(), mimetype=METRICS_CONTENT_TYPE)
 
 @app.route("/")
 def root():
     return "CSCD330 Lab3 server running."
 
+##################################
+# Async (ASGI) serving mode      #
+##################################
+
+# Same routes and plain-text responses as the Flask app, but every upstream
+# hop (DNS, whois streams, HTTP) is awaited instead of blocking a worker thread, so one process can
+# keep many slow whois/Census/weather.gov lookups in flight at once.
+# Needs: python3 -m pip install httpx uvicorn
+
+_async_client = None
+
+def async_http():
+    """Shared httpx.AsyncClient, created on first use inside the event loop."""
+    global _async_client
+    if _async_client is None:
+        from httpx import AsyncClient, Limits, Timeout
+        # Census + weather.gov are the only hosts, so this is ~HTTP_POOL_SIZE each
+        _async_client = AsyncClient(
+            limits=Limits(max_connections=HTTP_POOL_SIZE * 2,
+                          max_keepalive_connections=HTTP_POOL_SIZE * 2),
+            timeout=Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+    return _async_client
+
+async def async_http_attempt(url: str, **kwargs):
+    """http_attempt for the async mode; the request is cancelled when its timeout runs out."""
+    async with upstream_slot_async(http_upstream(url)) as call:
+        resp = await wait_for(async_http().get(url, **kwargs), call.timeout(HTTP_READ_TIMEOUT))
+        if resp.status_code >= 500:
+            resp.raise_for_status()
+        return resp
+
+async def async_http_get(url: str, **kwargs):
+    """http_get for the async mode: here the losing attempt really is cancelled."""
+    stage = current_stage.get()
+    delay = hedge_delay(stage)
+    if delay is None:
+        return await async_http_attempt(url, **kwargs)
+    budget = hedge_budgets[stage]
+    budget.deposit()
+    first = ensure_future(async_http_attempt(url, **kwargs))
+    attempts = [first]
+    try:
+        done, _ = await async_wait(attempts, timeout=delay)
+        if not done and budget.spend():
+            attempts.append(ensure_future(async_http_attempt(url, **kwargs)))
+            done, _ = await async_wait(attempts, return_when=ASYNC_FIRST_COMPLETED)
+            winner = next((a for a in done if a.exception() is None), None)
+            if winner is None:
+                # the first answer was an error; the other attempt may still succeed
+                winner = attempts[1] if first in done else first
+            elif winner is attempts[1]:
+                budget.record_win()
+            return await winner
+        return await first
+    finally:
+        for attempt in attempts:
+            attempt.cancel()  # no-op for the finished one
+
+async def dns_resolve_async(domain: str) -> DnsAnswer:
+    """dns_resolve on a non-blocking socket driven by the event loop."""
+    local = hosts_answer(domain)
+    if local is not None:
+        return local
+    loop = get_running_loop()
+    server = dns_server()
+    try:
+        if server is None:
+            raise DnsUnavailable("no nameserver configured")
+        if needs_system_resolver(domain):
+            raise DnsUnavailable("single-label name")
+        exchange = DnsExchange(domain)
+        with dns_socket(server) as sock:
+            sock.setblocking(False)
+            for packet in exchange.packets():
+                await loop.sock_sendall(sock, packet)
+            deadline = loop.time() + stage_timeout(DNS_TIMEOUT)
+            while not exchange.feed(await wait_for(loop.sock_recv(sock, 4096), deadline - loop.time())):
+                pass
+        return exchange.answer()
+    except (DnsUnavailable, OSError, ValueError, IndexError, AsyncTimeoutError) as e:
+        if isinstance(e, gaierror) and not isinstance(e, DnsNameError):
+            raise
+        if deadline_expired():
+            raise DeadlineExceeded(f"no DNS answer for {domain} within the time budget") from e
+    call = CallBudget("getaddrinfo")
+    try:
+        infos = await wait_for(loop.getaddrinfo(domain, None, proto=IPPROTO_TCP), call.timeout(DNS_FALLBACK_TIMEOUT))
+    except AsyncTimeoutError:
+        raise fallback_timed_out(domain, call) from None
+    return fallback_answer(infos)
+
+@async_cached_stage("resolve", key=resolve_key, ttl=dns_ttl)
+async def resolve_addresses_async(domain: str) -> DnsAnswer:
+    return await dns_resolve_async(domain)
+
+async def resolve_ip_async(domain: str) -> str:
+    """Domain -> IP string without blocking the event loop."""
+    return (await resolve_addresses_async(domain)).addresses[0]
+
+async def whois_exchange(host: str, port: int, query: str) -> bytes:
+    try:
+        reader, writer = await open_connection(host, port)
+    except gaierror as e:
+        raise whois_server_unknown(host, e) from e
+    try:
+        writer.write(query.encode() + b"\r\n")
+        await writer.drain()
+        return await reader.read()
+    finally:
+        writer.close()
+
+async def whois_query_async(server: str, query: str) -> str:
+    """whois_query on asyncio streams; the whole exchange is cancelled at its timeout."""
+    host, port = split_server(server)
+    async with upstream_slot_async(upstream_name(host, port, WHOIS_PORT), WHOIS_DEFAULT_LIMIT) as call:
+        data = await wait_for(whois_exchange(host, port, query), call.timeout(WHOIS_TIMEOUT))
+    return data.decode("utf-8", errors="replace")
+
+@async_cached_stage("whois")
+async def whois_lookup_async(ip: str) -> str:
+    """whois_lookup without blocking the event loop."""
+    server = first_whois_server(ip)
+    text = await whois_query_async(server, whois_query_line(server, ip))
+    for _ in range(WHOIS_MAX_REFERRALS):
+        ref = next_whois_server(ip, server, text)
+        if ref is None:
+            break
+        server = ref
+        text = await whois_query_async(server, whois_query_line(server, ip))
+    index_range(extract_range(text))
+    return text.rstrip("\n")
+
+@async_cached_stage("geocode", key=normalize_address, ttl=geocode_ttl)
+async def geocode_address_one_line_async(address: str):
+    resp = await async_http_get(CENSUS_ONELINE_URL, params=geocode_params(address))
+    resp.raise_for_status()
+    return parse_geocode(loads(resp.text))
+
+@async_cached_stage("points", key=quantize_point)
+async def lookup_grid_async(lat: float, lon: float):
+    lat, lon = quantize_point(lat, lon)
+    p = await async_http_get(f"{WEATHER_API_URL}/points/{lat},{lon}", headers=WEATHER_HEADERS)
+    return parse_points(loads(p.text))
+
+@async_cached_stage("forecast", key=grid_key)
+async def grid_forecast_async(cell) -> str:
+    f = await async_http_get(cell[3], headers=WEATHER_HEADERS)
+    return parse_forecast(loads(f.text))
+
+async def get_forecast_text_async(lat: float, lon: float) -> str:
+    return await grid_forecast_async(await lookup_grid_async(lat, lon))
+
+async def domain_whois_async(domain: str) -> str:
+    return await whois_lookup_async(await resolve_ip_async(domain))
+
+async def compute_address_async(domain: str) -> str:
+    return require_address(await domain_whois_async(domain))
+
+async def compute_weather_async(domain: str) -> str:
+    addr = require_address(await domain_whois_async(domain), "Forecast not found (no address in whois)")
+    lat, lon = require_latlon(await geocode_address_one_line_async(addr))
+    return await get_forecast_text_async(lat, lon)
+
+async def compute_range_async(domain: str) -> str:
+    ip = await resolve_ip_async(domain)
+    rng = find_range(ip)
+    if rng is None:
+        rng = require_range(extract_range(await whois_lookup_async(ip)))
+    return f"Network range for {domain} is {rng}"
+
+ASYNC_ROUTE_COMPUTE = {
+    "address": compute_address_async,
+    "weather": compute_weather_async,
+    "range": compute_range_async,
+}
+
+async def serve_cached_async(route: str, domain: str) -> RouteResult:
+    start = perf_counter()
+    try:
+        with deadline_scope(route):
+            try:
+                # hard stop; the shared lookup itself is shielded and keeps going
+                return await wait_for(lookup_async(route, domain), ROUTE_DEADLINES[route])
+            except AsyncTimeoutError:
+                raise remember_failure(route, domain, DeadlineExceeded(
+                    f"no answer within {ROUTE_DEADLINES[route]:g}s")) from None
+    finally:
+        observe_route(route, perf_counter() - start)
+
+async def lookup_async(route: str, domain: str) -> RouteResult:
+    cached = await cached_route_result_async(route, domain)
+    if cached is not None:
+        return RouteResult(cached[0], True, cached[1])
+
+    key = (route, domain)
+    cached_failure(route, domain)
+    compute = ASYNC_ROUTE_COMPUTE[route]
+
+    async def compute_and_store():
+        value = await compute(domain)
+        if STORE_PATH:
+            await get_running_loop().run_in_executor(None, save_result, key, value)
+        return value
+
+    ttl = route_storage_ttl(route)
+    try:
+        return RouteResult(await cache.aget_or_compute(key, compute_and_store, ttl), False, ttl)
+    except Exception as e:
+        raise remember_failure(route, domain, e) from e
+
+# POST /batch lookups running at once, across all batches (like batch_pool)
+batch_slots = Semaphore(BATCH_WORKERS)
+
+async def batch_record_async(domain: str, fields: list) -> dict:
+    """batch_record for async mode."""
+    record = {"domain": domain}
+    async with batch_slots:
+        for field in fields:
+            try:
+                with deadline_scope(field):
+                    record[field] = (await lookup_async(field, domain)).value
+            except Exception as e:
+                record.setdefault("errors", {})[field] = str(e) or type(e).__name__
+    return record
+
+async def batch_stream_async(domains: list, fields: list):
+    """NDJSON lines for POST /batch, in completion order."""
+    tasks = [ensure_future(batch_record_async(d, fields)) for d in domains]
+    try:
+        for next_done in async_as_completed(tasks):
+            yield dumps(await next_done) + "\n"
+    finally:
+        # client went away: don't run lookups nobody will read
+        for task in tasks:
+            task.cancel()
+
+def json_body(body: bytes, headers: dict):
+    """The request body parsed as JSON, or None; like Flask's get_json(silent=True)."""
+    mimetype = headers.get("content-type", "").split(";")[0].strip().lower()
+    if mimetype != "application/json" and not (mimetype.startswith("application/") and mimetype.endswith("+json")):
+        return None
+    try:
+        return loads(body)
+    except ValueError:
+        return None
+
+async def handle_async_request(method: str, path: str, headers=None, body: bytes = b""):
+    """
+    Route a request path to (status, body, headers) the same way the Flask
+    app does. Request header names in `headers` are lowercase. The returned
+    body is a str, or an async iterator of str chunks for a streamed response.
+    """
+    headers = headers or {}
+    if path == "/batch" and method == "POST":
+        try:
+            domains, fields = batch_params(json_body(body, headers))
+        except ValueError as e:
+            return 400, str(e), {}
+        return 200, batch_stream_async(domains, fields), {"Content-Type": "application/x-ndjson"}
+    if path == "/geocode/batch" and method == "POST":
+        text, status = start_batch_geocode(json_body(body, headers), body.decode("utf-8", "replace"))
+        return status, text, {}
+    if method not in ("GET", "HEAD") or path in ("/batch", "/geocode/batch"):
+        return 405, "Method Not Allowed", {}
+    if path == "/":
+        return 200, root(), {}
+    if path == "/cache/stats":
+        return 200, cache_stats_route(), PLAIN_TEXT
+    if path == "/metrics":
+        # same header Flask sends for the metrics_route Response
+        return 200, render_metrics(), {"Content-Type": f"{METRICS_CONTENT_TYPE}; charset=utf-8"}
+    if path == "/warmup":
+        return 200, warmup_route(), PLAIN_TEXT
+
+    parts = path.strip("/").split("/")
+    if len(parts) == 2 and parts[0] in ASYNC_ROUTE_COMPUTE and parts[1]:
+        try:
+            result = await serve_cached_async(parts[0], parts[1])
+        except LookupFailed as e:
+            return failure_response(e)
+        return route_response(parts[0], result, headers.get("if-none-match"),
+                              headers.get("if-modified-since"))
+    return 404, "Not Found", {}
+
+async def asgi_app(scope, receive, send):
+    """Minimal ASGI application, e.g. `uvicorn lab3:asgi_app --port 5000`."""
+    global _async_client
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _async_client is not None:
+                    await _async_client.aclose()
+                    _async_client = None
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    request_headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+    request_body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        request_body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    status, body, headers = await handle_async_request(scope["method"], scope["path"], request_headers, request_body)
+    response_headers = {"content-type": "text/html; charset=utf-8"}
+    response_headers.update((k.lower(), v) for k, v in headers.items())
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.encode(), v.encode()) for k, v in response_headers.items()],
+    })
+    if isinstance(body, str):
+        if scope["method"] == "HEAD":
+            body = ""
+        await send({"type": "http.response.body", "body": body.encode()})
+        return
+    # streamed: stop producing chunks as soon as the client goes away (the
+    # body has been read, so the next message can only be http.disconnect)
+    streaming = ensure_future(send_stream(body, send))
+    disconnected = ensure_future(receive())
+    done, _ = await async_wait((streaming, disconnected), return_when=ASYNC_FIRST_COMPLETED)
+    streaming.cancel()
+    disconnected.cancel()
+    if streaming in done:
+        streaming.result()
+
+async def send_stream(chunks, send):
+    """Send each chunk of a streamed response body as it is ready."""
+    try:
+        async for chunk in chunks:
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await chunks.aclose()
+
 if __name__ == "__main__":
-    # default: localhost:5000
-    app.run()
+    # open the on-disk store now rather than on the first request
+    result_store()
+    if "--warm" in argv[1:-1]:
+        start_warmup(argv[argv.index("--warm") + 1])
+    elif environ.get("LAB3_WARM_FILE"):
+        start_warmup(environ["LAB3_WARM_FILE"])
+
+    # default: localhost:5000 (LAB3_PORT moves it, e.g. for bench_load.py)
+    port = int(environ.get("LAB3_PORT", "5000"))
+    if "--asgi" in argv[1:]:
+        # async mode on the same default address as Flask
+        import uvicorn
+        uvicorn.run(asgi_app, host="127.0.0.1", port=port)
+    else:
+        app.run(port=port)
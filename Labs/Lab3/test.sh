@@ -52,3 +52,20 @@ echo
 echo "== weather 2nd (cache) =="
 curl localhost:5000/weather/google.com
 divider
+
+echo "== batch =="
+curl -s -X POST localhost:5000/batch \
+  -H "Content-Type: application/json" \
+  -d '{"domains": ["ewu.edu", "nasa.gov", "google.com"], "fields": ["address", "range"]}'
+divider
+
+echo "== conditional GET (expect 304) =="
+etag=$(curl -sI localhost:5000/address/ewu.edu | grep -i "^etag:" | cut -d" " -f2- | tr -d "\r")
+curl -s -o /dev/null -w "%{http_code}\n" -H "If-None-Match: $etag" localhost:5000/address/ewu.edu
+divider
+
+echo "== cache stats =="
+curl localhost:5000/cache/stats
+echo
+echo "== metrics =="
+curl -s localhost:5000/metrics | grep -v "^#" | grep -v "_bucket"
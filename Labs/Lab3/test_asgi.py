@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# author: Joel Sivanish
+#
+# Tests for lab3's async mode (asgi_app), driven with scripted ASGI
+# receive/send calls, so no server or network is needed.
+#
+# Usage: python3 -m pytest test_asgi.py
+# Skipped if lab3's dependencies (flask, requests) aren't installed.
+
+import asyncio
+import gc
+from itertools import count
+from json import dumps, loads
+from os import environ
+from queue import Queue
+from time import monotonic
+
+import pytest
+
+# don't create the server's on-disk cache just to run the tests
+environ.setdefault("LAB3_DB", "")
+
+pytest.importorskip("flask")
+pytest.importorskip("requests")
+import lab3  # noqa: E402
+
+# the route cache is shared by the whole module, so every test uses
+# domains no other test does
+domain_numbers = count()
+
+
+class Response:
+    def __init__(self, messages: list):
+        start = messages[0]
+        self.status = start["status"]
+        self.headers = {k.decode(): v.decode() for k, v in start["headers"]}
+        self.chunks = [m["body"] for m in messages[1:] if m["body"]]
+        self.text = b"".join(self.chunks).decode()
+
+
+def call(method: str, path: str, body: bytes = b"", content_type: str = None, hang_up_after: int = None) -> Response:
+    """
+    Run one request through asgi_app. With hang_up_after, the client
+    disconnects once that many body chunks have arrived.
+    """
+    headers = [(b"content-type", content_type.encode())] if content_type else []
+    scope = {"type": "http", "method": method, "path": path, "headers": headers}
+
+    async def run():
+        messages = []
+        hung_up = asyncio.Event()
+        requests = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await hung_up.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+            if hang_up_after is not None and len(messages) > hang_up_after:
+                hung_up.set()
+
+        await lab3.asgi_app(scope, receive, send)
+        return Response(messages)
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def cached_ranges():
+    """Three domains whose /range answers are already in the route cache."""
+    domains = [f"batch{next(domain_numbers)}.example" for _ in range(3)]
+    for domain in domains:
+        lab3.cache.set(("range", domain), f"Network range for {domain} is 10.0.0.0 - 10.0.0.255", 60)
+    return domains
+
+
+#############################
+# Tests                     #
+#############################
+
+def test_batch_streams_ndjson(cached_ranges):
+    body = dumps({"domains": cached_ranges + [cached_ranges[0]], "fields": ["range"]}).encode()
+    resp = call("POST", "/batch", body, "application/json")
+    assert resp.status == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+    records = [loads(line) for line in resp.text.splitlines()]
+    assert sorted(r["domain"] for r in records) == cached_ranges  # duplicates dropped
+    assert all(r["range"].startswith("Network range for") for r in records)
+
+
+def test_batch_rejects_bad_bodies():
+    assert call("POST", "/batch", b'{"domains": ["a.com"]}').status == 400  # not sent as JSON
+    assert call("POST", "/batch", b'{"domains": "a.com"}', "application/json").status == 400
+    assert call("POST", "/batch", b'{"domains": ["a.com"], "fields": ["nope"]}', "application/json").status == 400
+    assert call("POST", "/batch", b'{"domains": ["a.com"], "fields": [{}]}', "application/json").status == 400
+    assert call("GET", "/batch").status == 405
+
+
+def test_batch_stops_when_client_hangs_up(monkeypatch):
+    cancelled = []
+
+    async def slow_lookup(route, domain):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append(domain)
+            raise
+
+    monkeypatch.setattr(lab3, "lookup_async", slow_lookup)
+    body = dumps({"domains": ["a.example", "b.example"], "fields": ["range"]}).encode()
+    start = monotonic()
+    resp = call("POST", "/batch", body, "application/json", hang_up_after=0)
+    assert monotonic() - start < 5
+    assert resp.status == 200 and resp.text == ""
+    assert sorted(cancelled) == ["a.example", "b.example"]
+
+
+def test_geocode_batch(monkeypatch):
+    submitted = Queue()
+    monkeypatch.setattr(lab3, "batch_geocode", lambda addresses: submitted.put(addresses) or {})
+    resp = call("POST", "/geocode/batch", b"1 Main St, Cheney, WA, 99004\n\n2 Main St, Cheney, WA, 99004\n")
+    assert resp.status == 202
+    assert submitted.get(timeout=5) == ["1 Main St, Cheney, WA, 99004", "2 Main St, Cheney, WA, 99004"]
+    assert call("POST", "/geocode/batch", b"").status == 400
+
+
+def test_plain_text_content_types():
+    assert call("GET", "/metrics").headers["content-type"] == "text/plain; version=0.0.4; charset=utf-8"
+    assert call("GET", "/cache/stats").headers["content-type"] == "text/plain; charset=utf-8"
+    assert call("GET", "/warmup").headers["content-type"] == "text/plain; charset=utf-8"
+    assert call("GET", "/").headers["content-type"] == "text/html; charset=utf-8"
+
+
+def test_deadline_leaves_no_unretrieved_task_exception(monkeypatch):
+    """
+    A lookup that outlives the route deadline finishes with DeadlineExceeded
+    after everyone stopped waiting for it; that must not be logged by asyncio
+    as "Task exception was never retrieved".
+    """
+    async def slow_range(domain):
+        await asyncio.sleep(0.3)
+        raise lab3.DeadlineExceeded("time budget spent before whois")
+
+    monkeypatch.setitem(lab3.ROUTE_DEADLINES, "range", 0.1)
+    monkeypatch.setitem(lab3.ASYNC_ROUTE_COMPUTE, "range", slow_range)
+    domain = f"slow{next(domain_numbers)}.example"
+
+    async def run():
+        unhandled = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        status, _, _ = await lab3.handle_async_request("GET", f"/range/{domain}")
+        await asyncio.sleep(0.5)  # the shared lookup finishes, unwatched
+        gc.collect()
+        await asyncio.sleep(0)
+        return status, unhandled
+
+    status, unhandled = asyncio.run(run())
+    assert status == 504
+    assert [c["message"] for c in unhandled] == []
+
+
+def test_coalesced_failure_counted_once(monkeypatch):
+    async def no_range(domain):
+        await asyncio.sleep(0.1)
+        raise lab3.NoResult("no_range", f"No range found for {domain}")
+
+    monkeypatch.setitem(lab3.ASYNC_ROUTE_COMPUTE, "range", no_range)
+    domain = f"norange{next(domain_numbers)}.example"
+    before = lab3.negative_results["no_range"]
+
+    async def run():
+        return await asyncio.gather(*(lab3.handle_async_request("GET", f"/range/{domain}") for _ in range(5)))
+
+    responses = asyncio.run(run())
+    assert [status for status, _, _ in responses] == [404] * 5
+    assert lab3.negative_results["no_range"] == before + 1
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# author: Joel Sivanish
+#
+# Tests for lab3's DNS stub resolver (dns_resolve, dns_resolve_async)
+# against a scripted UDP nameserver on localhost, standing in for the one
+# LAB3_DNS_SERVER points at: combined A + AAAA answers, CNAME chains with
+# compression pointers, the TTL clamp, the hosts file, and the getaddrinfo
+# fallbacks (truncation, SERVFAIL, NXDOMAIN, no answer, time budget).
+#
+# Usage: python3 -m pytest test_dns.py
+# Skipped if lab3's dependencies (flask, requests) aren't installed.
+
+import asyncio
+from os import environ
+from socket import AF_INET, AF_INET6, EAI_NONAME, gaierror, inet_aton, inet_pton
+from socketserver import BaseRequestHandler, ThreadingUDPServer
+from struct import pack, unpack_from
+from threading import Thread
+from time import monotonic, sleep
+
+import pytest
+
+# don't create the server's on-disk cache just to run the tests
+environ.setdefault("LAB3_DB", "")
+
+pytest.importorskip("flask")
+pytest.importorskip("requests")
+import lab3  # noqa: E402
+
+A, AAAA, CNAME = 1, 28, 5
+NOERROR, SERVFAIL, NXDOMAIN = 0, 2, 3
+QUESTION = b"\xc0\x0c"  # compression pointer to the question's name
+
+
+#############################
+# Stub nameserver           #
+#############################
+
+def rr(name: bytes, rtype: int, ttl: int, rdata: bytes) -> bytes:
+    return name + pack("!HHIH", rtype, 1, ttl, len(rdata)) + rdata
+
+def a_record(ip: str, ttl: int = 300, name: bytes = QUESTION) -> bytes:
+    return rr(name, A, ttl, inet_aton(ip))
+
+def aaaa_record(ip: str, ttl: int = 300, name: bytes = QUESTION) -> bytes:
+    return rr(name, AAAA, ttl, inet_pton(AF_INET6, ip))
+
+def encode_name(name: str) -> bytes:
+    return b"".join(bytes([len(l)]) + l.encode() for l in name.split(".")) + b"\0"
+
+
+class Reply:
+    def __init__(self, records=(), rcode: int = NOERROR, truncated: bool = False):
+        self.records = list(records)
+        self.rcode = rcode
+        self.truncated = truncated
+
+
+class StubDnsHandler(BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        stub = self.server.stub
+        qid, = unpack_from("!H", data)
+        off, labels = 12, []
+        while data[off]:
+            labels.append(data[off + 1:off + 1 + data[off]].decode())
+            off += 1 + data[off]
+        qtype, = unpack_from("!H", data, off + 1)
+        question = data[12:off + 5]
+        stub.queries.append((".".join(labels), qtype))
+        # answer(name, qtype, offset of the answer section) -> Reply, or None to drop
+        reply = stub.answer(".".join(labels), qtype, 12 + len(question))
+        if reply is None:
+            return
+        flags = 0x8180 | reply.rcode | (0x0200 if reply.truncated else 0)
+        header = pack("!HHHHHH", qid, flags, 1, len(reply.records), 0, 0)
+        sock.sendto(header + question + b"".join(reply.records), self.client_address)
+
+
+class StubDns:
+    def __init__(self, answer):
+        self.answer = answer
+        self.queries = []
+        ThreadingUDPServer.daemon_threads = True
+        self.server = ThreadingUDPServer(("127.0.0.1", 0), StubDnsHandler)
+        self.server.stub = self
+        self.address = "127.0.0.1:%d" % self.server.server_address[1]
+        Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SystemResolver:
+    """Stands in for getaddrinfo: answers every name with one address, after delay seconds."""
+
+    def __init__(self, ip: str = "192.0.2.99", delay: float = 0, error: Exception = None):
+        self.ip, self.delay, self.error = ip, delay, error
+        self.calls = []
+
+    def answer(self, host):
+        self.calls.append(host)
+        if self.error is not None:
+            raise self.error
+        return [(AF_INET, 1, 6, "", (self.ip, 0))]
+
+    def __call__(self, host, port, *args, **kwargs):
+        sleep(self.delay)
+        return self.answer(host)
+
+    async def async_getaddrinfo(self, host, port, *args, **kwargs):
+        await asyncio.sleep(self.delay)
+        return self.answer(host)
+
+
+@pytest.fixture
+def dns(monkeypatch, tmp_path):
+    """Point lab3 at a stub nameserver; set .answer on it per test."""
+    stub = StubDns(lambda name, qtype, off: Reply())
+    monkeypatch.setattr(lab3, "DNS_SERVER", stub.address)
+    monkeypatch.setattr(lab3, "DNS_TIMEOUT", 0.3)
+    # an empty hosts file unless a test writes one
+    monkeypatch.setattr(lab3, "HOSTS_FILE", str(tmp_path / "hosts"))
+    monkeypatch.setattr(lab3, "hosts_cache", (None, {}))
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def system(monkeypatch):
+    resolver = SystemResolver()
+    monkeypatch.setattr(lab3, "getaddrinfo", resolver)
+    return resolver
+
+
+def resolve_async(domain: str, resolver: SystemResolver = None):
+    async def run():
+        if resolver is not None:
+            asyncio.get_running_loop().getaddrinfo = resolver.async_getaddrinfo
+        return await lab3.dns_resolve_async(domain)
+    return asyncio.run(run())
+
+RESOLVERS = {"sync": lambda domain, resolver=None: lab3.dns_resolve(domain), "async": resolve_async}
+
+@pytest.fixture(params=sorted(RESOLVERS))
+def resolve(request):
+    return RESOLVERS[request.param]
+
+
+#############################
+# Tests                     #
+#############################
+
+def test_a_and_aaaa_combined(dns, resolve):
+    dns.answer = lambda name, qtype, off: Reply(
+        [a_record("198.51.100.7", 300)] if qtype == A else [aaaa_record("2001:db8::7", 120)])
+    answer = resolve("www.example.test")
+    assert answer.addresses == ("198.51.100.7", "2001:db8::7")  # IPv4 first
+    assert answer.ttl == 120  # the shortest record's
+    assert sorted(qtype for _, qtype in dns.queries) == [A, AAAA]
+
+
+def test_cname_chain_with_compression(dns, resolve):
+    def answer(name, qtype, off):
+        if qtype != A:
+            return Reply()
+        # www.example.test -> edge.example.test -> cdn.example.net -> A, each
+        # owner name a pointer into the packet, rdata compressed where it can be
+        first = rr(QUESTION, CNAME, 300, b"\x04edge\xc0\x10")  # "edge" + the question's "example.test"
+        second_name = pack("!H", 0xC000 | (off + 12))          # the first record's rdata
+        second = rr(second_name, CNAME, 300, encode_name("cdn.example.net"))
+        third_name = pack("!H", 0xC000 | (off + len(first) + 12))
+        return Reply([first, second, a_record("203.0.113.5", 60, third_name)])
+
+    dns.answer = answer
+    assert resolve("www.example.test").addresses == ("203.0.113.5",)
+
+
+@pytest.mark.parametrize("ttl, clamped", [(0, 5), (1, 5), (3600, 3600), (10 ** 7, 24 * 60 * 60)])
+def test_ttl_clamp(dns, ttl, clamped):
+    dns.answer = lambda name, qtype, off: Reply([a_record("198.51.100.8", ttl)] if qtype == A else [])
+    assert lab3.dns_resolve("clamp.example.test").ttl == clamped
+
+
+def test_hosts_file_first(dns, resolve, tmp_path):
+    (tmp_path / "hosts").write_text("# comment\n10.9.8.7  box.example.test box\n::1 box.example.test\n")
+    answer = resolve("BOX.example.test.")
+    assert answer == lab3.DnsAnswer(("10.9.8.7", "::1"), lab3.DNS_FALLBACK_TTL)
+    assert dns.queries == []
+
+
+@pytest.mark.parametrize("reply", [Reply(truncated=True), Reply(rcode=SERVFAIL), Reply(rcode=NXDOMAIN), None],
+                         ids=["truncated", "servfail", "nxdomain", "no-answer"])
+def test_falls_back_to_getaddrinfo(dns, system, resolve, reply):
+    dns.answer = lambda name, qtype, off: reply
+    before = lab3.dns_fallbacks
+    answer = resolve("fallback.example.test", system)
+    assert answer == lab3.DnsAnswer(("192.0.2.99",), lab3.DNS_FALLBACK_TTL)
+    assert system.calls == ["fallback.example.test"]
+    assert lab3.dns_fallbacks == before + 1
+
+
+def test_nxdomain_when_getaddrinfo_agrees(dns, system, resolve):
+    dns.answer = lambda name, qtype, off: Reply(rcode=NXDOMAIN)
+    system.error = gaierror(EAI_NONAME, "Name or service not known")
+    with pytest.raises(gaierror) as caught:
+        resolve("missing.example.test", system)
+    assert caught.value.errno == EAI_NONAME
+
+
+def test_single_label_name_goes_to_getaddrinfo(dns, system, resolve):
+    assert resolve("intranet", system).addresses == ("192.0.2.99",)
+    assert dns.queries == []
+
+
+def test_fallback_bounded_by_deadline(dns, system, resolve, monkeypatch):
+    dns.answer = lambda name, qtype, off: Reply(rcode=SERVFAIL)
+    system.delay = 2
+    monkeypatch.setitem(lab3.ROUTE_DEADLINES, "range", 0.3)
+    start = monotonic()
+    with pytest.raises(lab3.DeadlineExceeded):
+        with lab3.deadline_scope("range"), lab3.stage_scope("resolve"):
+            resolve("slow.example.test", system)
+    assert monotonic() - start < 1.5
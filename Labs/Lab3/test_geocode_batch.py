@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# author: Joel Sivanish
+#
+# Tests for lab3's Census batch geocoding (batch_geocode, POST /geocode/batch)
+# against a scripted stand-in for the Census geocoder on localhost.
+#
+# Usage: python3 -m pytest test_geocode_batch.py
+# Skipped if lab3's dependencies (flask, requests) aren't installed.
+
+from csv import reader as csv_reader
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from json import dumps
+from os import environ
+from threading import Thread
+from time import monotonic, sleep
+
+import pytest
+
+# don't create the server's on-disk cache just to run the tests
+environ.setdefault("LAB3_DB", "")
+
+pytest.importorskip("flask")
+pytest.importorskip("requests")
+import lab3  # noqa: E402
+
+# the geocode stage cache is shared by the whole module, so every test
+# geocodes street numbers no other test uses
+street_numbers = count(1000)
+
+
+#############################
+# Fake Census geocoder      #
+#############################
+
+class CensusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status: int, body: str, content_type: str):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        # onelineaddress: always two candidates, like a Tie; the first one wins
+        self.server.fake.oneline += 1
+        matches = [{"matchedAddress": "FIRST", "coordinates": {"x": -117.5, "y": 47.5}},
+                   {"matchedAddress": "SECOND", "coordinates": {"x": -118.0, "y": 48.0}}]
+        self.reply(200, dumps({"result": {"addressMatches": matches}}), "application/json")
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        if fake.status != 200:
+            return self.reply(fake.status, "upstream trouble", "text/plain")
+        # the uploaded CSV rows sit between the multipart boundaries
+        rows = [row for row in csv_reader(body.splitlines()) if len(row) == 5 and row[0].isdigit()]
+        fake.uploads.append(rows)
+        out = []
+        for row_id, street, city, state, zipc in rows:
+            answer = fake.answer(street)
+            if answer == "Match":
+                out.append([row_id, street, "Match", "Exact", street.upper(), "-117.1,47.1", "1", "L"])
+            elif answer is not None:
+                out.append([row_id, street, answer])
+        self.reply(200, "".join(",".join(f'"{v}"' for v in r) + "\n" for r in out), "text/csv")
+
+
+class FakeCensus:
+    """answer(street) -> "Match", "No_Match", "Tie", or None to leave the row out."""
+
+    def __init__(self, answer=lambda street: "Match"):
+        self.answer = answer
+        self.status = 200
+        self.uploads = []  # one list of CSV rows per batch request
+        self.oneline = 0   # one-line lookups served
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), CensusHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/geocoder"
+        Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def census(monkeypatch):
+    fake = FakeCensus()
+    monkeypatch.setattr(lab3, "CENSUS_BATCH_URL", f"{fake.url}/locations/addressbatch")
+    monkeypatch.setattr(lab3, "CENSUS_ONELINE_URL", f"{fake.url}/locations/onelineaddress")
+    monkeypatch.setattr(lab3, "upstream_schedulers", {})
+    yield fake
+    fake.close()
+
+
+def addresses(n: int) -> list:
+    return [f"{next(street_numbers)} Main St, Cheney, WA, 99004" for _ in range(n)]
+
+def cached(address: str):
+    return lab3.stage_caches["geocode"].get(lab3.normalize_address(address), lab3._MISSING)
+
+
+#############################
+# Tests                     #
+#############################
+
+def test_parse_batch_csv_keeps_only_matches():
+    text = ('"0","1 MAIN ST","Match","Exact","1 MAIN ST","-117.1,47.1","1","L"\n'
+            '"1","2 MAIN ST","Tie"\n'
+            '"2","3 MAIN ST","No_Match"\n'
+            '"3","4 MAIN ST","Match","Exact","4 MAIN ST","not a point","1","L"\n'
+            '"9","5 MAIN ST","Match","Exact","5 MAIN ST","-117.1,47.1","1","L"\n')
+    assert lab3.parse_batch_csv(text, 5) == {0: (47.1, -117.1)}
+
+
+def test_caches_matches_only(census):
+    rows = dict(zip(("Match", "Tie", "No_Match", "Missing"), addresses(4)))
+    kind_of = {address.split(",")[0]: kind for kind, address in rows.items()}
+    census.answer = lambda street: None if kind_of[street] == "Missing" else kind_of[street]
+    summary = lab3.batch_geocode(list(rows.values()))
+    assert summary == {"submitted": 4, "matched": 1, "failed_chunks": 0}
+    assert cached(rows["Match"]) == (47.1, -117.1)
+    for kind in ("Tie", "No_Match", "Missing"):
+        assert cached(rows[kind]) is lab3._MISSING, kind
+
+
+def test_tie_is_left_to_the_one_line_geocoder(census):
+    census.answer = lambda street: "Tie"
+    (address,) = addresses(1)
+    lab3.batch_geocode([address])
+    assert lab3.geocode_address_one_line(address) == (47.5, -117.5)
+    assert census.oneline == 1
+
+
+def test_skips_cached_and_duplicate_addresses(census):
+    first, second = addresses(2)
+    lab3.batch_geocode([first])
+    # same address after normalization, plus one new one twice
+    summary = lab3.batch_geocode([first.upper().replace(",", ""), second, second])
+    assert summary["submitted"] == 1
+    assert [row[1] for row in census.uploads[-1]] == [second.split(",")[0]]
+
+
+def test_uploads_in_chunks(census, monkeypatch):
+    monkeypatch.setattr(lab3, "CENSUS_BATCH_SIZE", 2)
+    batch = addresses(5)
+    summary = lab3.batch_geocode(batch)
+    assert summary == {"submitted": 5, "matched": 5, "failed_chunks": 0}
+    assert sorted(len(rows) for rows in census.uploads) == [1, 2, 2]
+    assert all(cached(a) == (47.1, -117.1) for a in batch)
+
+
+def test_failed_chunk_caches_nothing(census):
+    census.status = 500
+    (address,) = addresses(1)
+    summary = lab3.batch_geocode([address])
+    assert summary == {"submitted": 1, "matched": 0, "failed_chunks": 1}
+    assert cached(address) is lab3._MISSING
+
+
+def test_geocode_batch_route(census):
+    batch = addresses(3)
+    with lab3.app.test_client() as client:
+        resp = client.post("/geocode/batch", json={"addresses": batch})
+        assert resp.status_code == 202
+        assert client.post("/geocode/batch", data="").status_code == 400
+    # geocoding finishes in a background thread
+    end = monotonic() + 5
+    while monotonic() < end and any(cached(a) is lab3._MISSING for a in batch):
+        sleep(0.02)
+    assert all(cached(a) == (47.1, -117.1) for a in batch)
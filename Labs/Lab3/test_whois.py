@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# author: Joel Sivanish
+#
+# Tests for the native whois clients in lab2, lab3 (sync and async) and lab7,
+# against scripted port-43 servers on localhost. The clients' connect calls
+# are pointed at the fakes by hostname, so referrals to whois.arin.net or
+# whois.ripe.net (and ARIN's "n + <ip>" query form) behave as they do live.
+#
+# Usage: python3 -m pytest test_whois.py
+# Each client is skipped if its lab's dependencies aren't installed.
+
+import asyncio
+from importlib.util import module_from_spec, spec_from_file_location
+from os import environ
+from os.path import abspath, dirname, join
+from socket import EAI_NONAME, create_connection, gaierror, socket
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from sys import modules
+from threading import Event, Thread
+
+import pytest
+
+# don't create the server's on-disk cache just to run the tests
+environ.setdefault("LAB3_DB", "")
+
+LABS = dirname(dirname(abspath(__file__)))
+
+IANA_RIPE = "% IANA WHOIS server\n\nrefer:        whois.ripe.net\n\ninetnum:      193.0.0.0 - 193.255.255.255\n"
+IANA_ARIN = "% IANA WHOIS server\n\nrefer:        whois.arin.net\n\ninetnum:      8.0.0.0 - 8.255.255.255\n"
+RIPE_RECORD = "inetnum:        193.0.0.0 - 193.0.7.255\nnetname:        RIPE-NCC\naddress:        Stationsplein 11\n"
+ARIN_RECORD = ("NetRange:       8.8.8.0 - 8.8.8.255\nOriginAS:       AS15169\n"
+               "Address:        1600 Amphitheatre Parkway\nCity:           Mountain View\n")
+
+
+#############################
+# Fake whois servers        #
+#############################
+
+class FakeWhoisHandler(StreamRequestHandler):
+    def handle(self):
+        fake = self.server.fake
+        query = self.rfile.readline().decode().rstrip("\r\n")
+        fake.queries.append(query)
+        text = fake.answer(query)
+        if text is None:
+            fake.closing.wait(5)  # never answer; the client has to time out
+            return
+        self.wfile.write(text.encode())
+
+
+class FakeWhois:
+    """One scripted whois server: answer(query) -> reply text, or None to hang."""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.queries = []
+        self.closing = Event()
+        ThreadingTCPServer.daemon_threads = True
+        self.server = ThreadingTCPServer(("127.0.0.1", 0), FakeWhoisHandler)
+        self.server.fake = self
+        self.port = self.server.server_address[1]
+        Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.closing.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeNetwork:
+    """whois hostname -> local port; stands in for DNS + the internet."""
+
+    def __init__(self):
+        self.ports = {}
+        self.fakes = []
+
+    def serve(self, host: str, answer) -> FakeWhois:
+        fake = FakeWhois(answer if callable(answer) else (lambda query: answer))
+        self.fakes.append(fake)
+        self.ports[host] = fake.port
+        return fake
+
+    def refuse(self, host: str):
+        """Connections to host are refused (nothing listens on its port)."""
+        with socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.ports[host] = s.getsockname()[1]
+
+    def unknown(self, host: str):
+        """host doesn't resolve."""
+        self.ports[host] = None
+
+    def local(self, host: str, port: int):
+        if self.ports.get(host, 0) is None:
+            raise gaierror(EAI_NONAME, "Name or service not known")
+        if host not in self.ports:
+            raise ConnectionRefusedError(f"no fake whois server for {host}:{port}")
+        return "127.0.0.1", self.ports[host]
+
+    def create_connection(self, address, timeout=None, *args, **kwargs):
+        return create_connection(self.local(*address), timeout=timeout)
+
+    async def open_connection(self, host, port, **kwargs):
+        return await asyncio.open_connection(*self.local(host, port))
+
+    def close(self):
+        for fake in self.fakes:
+            fake.close()
+
+
+@pytest.fixture
+def network():
+    net = FakeNetwork()
+    yield net
+    net.close()
+
+
+#############################
+# The three clients         #
+#############################
+
+def load_lab(lab: str, name: str, *requires):
+    """Import Labs/<lab>/<name>.py, skipping the test if its dependencies are missing."""
+    for dependency in requires:
+        pytest.importorskip(dependency)
+    if name not in modules:
+        spec = spec_from_file_location(name, join(LABS, lab, f"{name}.py"))
+        module = module_from_spec(spec)
+        modules[name] = module
+        spec.loader.exec_module(module)
+    return modules[name]
+
+
+class Client:
+    """A whois_lookup(ip) to test, and the exception it reports failures with."""
+
+    def __init__(self, lookup, failure):
+        self.lookup = lookup
+        self.failure = failure
+
+
+def lab2_client(monkeypatch, network):
+    lab2 = load_lab("Lab2", "lab2", "requests")
+    monkeypatch.setattr(lab2, "create_connection", network.create_connection)
+    monkeypatch.setattr(lab2, "WHOIS_SERVER", "whois.iana.org")
+    monkeypatch.setattr(lab2, "WHOIS_TIMEOUT", 0.3)
+    return Client(lab2.whois_lookup, RuntimeError)
+
+
+def lab3_module(monkeypatch, network):
+    lab3 = load_lab("Lab3", "lab3", "flask", "requests")
+    monkeypatch.setattr(lab3, "create_connection", network.create_connection)
+    monkeypatch.setattr(lab3, "open_connection", network.open_connection)
+    monkeypatch.setattr(lab3, "WHOIS_SERVER", "whois.iana.org")
+    monkeypatch.setattr(lab3, "WHOIS_TIMEOUT", 0.3)
+    # fresh referral shortcuts, schedulers and circuit breakers per test
+    monkeypatch.setattr(lab3, "whois_referrals", {})
+    monkeypatch.setattr(lab3, "upstream_schedulers", {})
+    return lab3
+
+
+def lab3_client(monkeypatch, network):
+    lab3 = lab3_module(monkeypatch, network)
+    # __wrapped__ skips the whois stage cache
+    return Client(lab3.whois_lookup.__wrapped__, OSError)
+
+
+def lab3_async_client(monkeypatch, network):
+    lab3 = lab3_module(monkeypatch, network)
+    lookup = lab3.whois_lookup_async.__wrapped__
+    return Client(lambda ip: asyncio.run(lookup(ip)), (OSError, asyncio.TimeoutError))
+
+
+def lab7_client(monkeypatch, network):
+    lab7 = load_lab("Lab7", "lab7", "scapy")
+    monkeypatch.setattr(lab7, "create_connection", network.create_connection)
+    monkeypatch.setattr(lab7, "WHOIS_SERVER", "whois.iana.org")
+    monkeypatch.setattr(lab7, "WHOIS_TIMEOUT", 0.3)
+    return Client(lab7.whois_lookup, OSError)
+
+
+CLIENTS = {"lab2": lab2_client, "lab3": lab3_client, "lab3-async": lab3_async_client, "lab7": lab7_client}
+
+@pytest.fixture(params=sorted(CLIENTS))
+def client(request, monkeypatch, network):
+    return CLIENTS[request.param](monkeypatch, network)
+
+
+#############################
+# Tests                     #
+#############################
+
+def test_follows_iana_refer(client, network):
+    iana = network.serve("whois.iana.org", IANA_RIPE)
+    ripe = network.serve("whois.ripe.net", RIPE_RECORD)
+    text = client.lookup("193.0.6.139")
+    assert "Stationsplein 11" in text
+    assert iana.queries == ["193.0.6.139"]
+    assert ripe.queries == ["193.0.6.139"]  # plain IP everywhere but ARIN
+
+
+def test_arin_gets_n_plus_query(client, network):
+    network.serve("whois.iana.org", IANA_ARIN)
+    arin = network.serve("whois.arin.net", ARIN_RECORD)
+    text = client.lookup("8.8.8.8")
+    assert "OriginAS:       AS15169" in text
+    assert arin.queries == ["n + 8.8.8.8"]
+
+
+def test_follows_arin_referral_server(client, network):
+    network.serve("whois.iana.org", IANA_ARIN)
+    arin = network.serve("whois.arin.net", ARIN_RECORD + "ReferralServer:  whois://whois.ripe.net\n")
+    ripe = network.serve("whois.ripe.net", RIPE_RECORD)
+    text = client.lookup("193.0.6.139")
+    assert "Stationsplein 11" in text
+    assert arin.queries == ["n + 193.0.6.139"]
+    assert ripe.queries == ["193.0.6.139"]
+
+
+def test_skips_rwhois_referral(client, network):
+    network.serve("whois.iana.org", IANA_ARIN)
+    network.serve("whois.arin.net", ARIN_RECORD + "ReferralServer:  rwhois://rwhois.example.net:4321\n")
+    text = client.lookup("8.8.8.8")
+    assert "1600 Amphitheatre Parkway" in text  # ARIN's answer; rwhois isn't spoken
+
+
+def test_referral_to_itself_stops(client, network):
+    iana = network.serve("whois.iana.org", "refer:        whois.iana.org\n" + RIPE_RECORD)
+    text = client.lookup("193.0.6.139")
+    assert "Stationsplein 11" in text
+    assert len(iana.queries) == 1
+
+
+def test_timeout(client, network):
+    network.serve("whois.iana.org", None)
+    with pytest.raises(client.failure):
+        client.lookup("193.0.6.139")
+
+
+def test_connection_refused(client, network):
+    network.refuse("whois.iana.org")
+    with pytest.raises(client.failure):
+        client.lookup("193.0.6.139")
+
+
+def test_referred_server_down(client, network):
+    network.serve("whois.iana.org", IANA_RIPE)
+    network.refuse("whois.ripe.net")
+    with pytest.raises(client.failure):
+        client.lookup("193.0.6.139")
+
+
+def test_lab3_whois_server_name_unknown_is_upstream_error(monkeypatch, network):
+    lab3 = lab3_module(monkeypatch, network)
+    network.serve("whois.iana.org", "refer:        whois.nowhere.invalid\n")
+    network.unknown("whois.nowhere.invalid")
+    with pytest.raises(OSError) as caught:
+        lab3.whois_lookup.__wrapped__("193.0.6.139")
+    assert not isinstance(caught.value, lab3.gaierror)
+    assert lab3.classify_failure("example.com", caught.value).kind == "upstream_error"
+
+
+def test_lab7_as_number_falls_back_to_generic_whois(monkeypatch, network):
+    lab7_client(monkeypatch, network)
+    lab7 = modules["lab7"]
+    network.refuse("whois.cymru.com")
+    network.serve("whois.iana.org", IANA_ARIN)
+    network.serve("whois.arin.net", ARIN_RECORD)
+    assert lab7.lookup_as_number("8.8.8.8") == "AS15169"
+
+
+def test_lab7_as_number_none_when_whois_fails(monkeypatch, network):
+    lab7_client(monkeypatch, network)
+    lab7 = modules["lab7"]
+    network.serve("whois.cymru.com", None)
+    network.refuse("whois.iana.org")
+    assert lab7.lookup_as_number("8.8.8.8") is None
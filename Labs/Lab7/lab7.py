@@ -2,15 +2,77 @@
 # author: Joel Sivanish
 
 from scapy.all import IP, TCP, sr1
-from socket import gethostbyname
+from os import environ
+from socket import create_connection, gethostbyname
 from subprocess import getstatusoutput
 from sys import argv
 
+# whois is spoken directly over TCP port 43 (adapted from lab3).
+# Generic lookups start at IANA (or LAB7_WHOIS_SERVER as "host[:port]").
+WHOIS_SERVER = environ.get("LAB7_WHOIS_SERVER", "whois.iana.org")
+CYMRU_WHOIS_SERVER = "whois.cymru.com"
+WHOIS_PORT = 43
+WHOIS_TIMEOUT = 10
+WHOIS_MAX_REFERRALS = 3
+
 
 def usage():
     print(f"Usage: {argv[0]} <target host> <max hops>")
 
 
+def split_server(server):
+    """'host' or 'host:port' -> (host, port)."""
+    host, _, port = server.partition(":")
+    return host, int(port) if port.isdigit() else WHOIS_PORT
+
+
+def whois_query(server, query):
+    """Send one whois query over TCP/43 and read until the server closes."""
+    with create_connection(split_server(server), timeout=WHOIS_TIMEOUT) as sock:
+        sock.sendall(query.encode() + b"\r\n")
+        chunks = []
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            chunks.append(data)
+    return b"".join(chunks).decode("utf-8", errors="replace")
+
+
+def whois_referral(output):
+    """Return the next whois server named in a response (IANA refer:/ARIN ReferralServer:)."""
+    for line in output.splitlines():
+        if ":" not in line:
+            continue
+        key, val = line.split(":", 1)
+        key = key.strip().lower()
+        val = val.strip()
+        if key in ("refer", "whois") and val:
+            return val
+        if key == "referralserver" and val.startswith("whois://"):
+            return val[len("whois://"):].rstrip("/")
+    return None
+
+
+def whois_lookup(ip_addr):
+    """
+    Generic whois for an IP: start at IANA and follow referrals to the
+    registry that holds the record. Returns that server's text output.
+    """
+    server = WHOIS_SERVER
+    query = ip_addr
+    output = whois_query(server, query)
+    for _ in range(WHOIS_MAX_REFERRALS):
+        ref = whois_referral(output)
+        if ref is None or split_server(ref) == split_server(server):
+            break
+        server = ref
+        # ARIN only returns the full network record (with OriginAS) for "n + <ip>"
+        query = f"n + {ip_addr}" if split_server(server)[0] == "whois.arin.net" else ip_addr
+        output = whois_query(server, query)
+    return output
+
+
 def lookup_as_number(ip_addr):
     """
     Look up the AS number for a given IP address using whois.
@@ -19,13 +81,15 @@ def lookup_as_number(ip_addr):
     falls back to a generic whois and searches for an origin/AS line.
     Returns a string like 'AS15169' or None if not found.
     """
-    # Try Team Cymru whois (if available on the system)
-    # Example command:
+    # Try Team Cymru whois
+    # Same query as:
     #   whois -h whois.cymru.com " -v 8.8.8.8"
-    cymru_cmd = f'whois -h whois.cymru.com " -v {ip_addr}"'
-    status, output = getstatusoutput(cymru_cmd)
+    try:
+        output = whois_query(CYMRU_WHOIS_SERVER, f" -v {ip_addr}")
+    except OSError:
+        output = None
 
-    if status == 0:
+    if output is not None:
         for line in output.splitlines():
             line = line.strip()
             # Skip headers, look for first data line starting with digit(s)
@@ -39,10 +103,9 @@ def lookup_as_number(ip_addr):
                 break  # don't keep searching if format is weird
 
     # Fallback: generic whois
-    generic_cmd = f"whois {ip_addr}"
-    status, output = getstatusoutput(generic_cmd)
-
-    if status != 0:
+    try:
+        output = whois_lookup(ip_addr)
+    except OSError:
         return None
 
     for line in output.splitlines():